@@ -1,3 +1,5 @@
+import threading
+import time
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
@@ -6,6 +8,26 @@ from .database import mongodb
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+# The JWT is verified on every request; only the user document is reused,
+# so Mongo is hit at most once per user per USER_CACHE_TTL seconds
+USER_CACHE_TTL = 300
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def get_cached_user(username: str):
+    now = time.monotonic()
+    with _user_cache_lock:
+        hit = _user_cache.get(username)
+    if hit and now - hit[0] < USER_CACHE_TTL:
+        return hit[1]
+    user = mongodb.users.find_one({"username": username})
+    if user is not None:
+        with _user_cache_lock:
+            if len(_user_cache) >= 10000:
+                _user_cache.clear()
+            _user_cache[username] = (now, user)
+    return user
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=401,
@@ -21,7 +43,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
     
-    user = mongodb.users.find_one({"username": username})
+    user = get_cached_user(username)
     if user is None:
         raise credentials_exception
     
@@ -8,6 +8,12 @@ NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
 NEO4J_USERNAME = os.getenv("NEO4J_USERNAME", "neo4j")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
 POSTGRES_URI = os.getenv("POSTGRES_URI")
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "2"))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10"))
+POSTGRES_INDEX_KIND = os.getenv("POSTGRES_INDEX_KIND", "hnsw")
+POSTGRES_MAINTENANCE_WORK_MEM = os.getenv("POSTGRES_MAINTENANCE_WORK_MEM", "2GB")
+POSTGRES_PREWARM = os.getenv("POSTGRES_PREWARM", "false").lower() == "true"
+POSTGRES_BRUTE_FORCE_MAX_ROWS = int(os.getenv("POSTGRES_BRUTE_FORCE_MAX_ROWS", "10000"))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SECRET_KEY = os.getenv("SECRET_KEY", "supersecret")
 
@@ -16,5 +22,6 @@ COLLECTIONS = {
     "users": "users",
     "risks": "finalized_risks", 
     "controls": "controls",
-    "sessions": "agent_sessions"
+    "sessions": "agent_sessions",
+    "pending_embeddings": "pending_embeddings"
 }
\ No newline at end of file
@@ -1,8 +1,48 @@
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from motor.motor_asyncio import AsyncIOMotorClient
 from .config import MONGODB_URI, DATABASE_NAME, COLLECTIONS
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from bson import ObjectId
+from datetime import datetime, timezone
+import asyncio
+import re
+import threading
+import time
 import uuid
+import weakref
+
+# Enforced by Mongo on insert so callers can hand whole batches to
+# insert_many without checking each control first
+CONTROL_VALIDATOR = {
+    "$jsonSchema": {
+        "bsonType": "object",
+        "required": ["control_id", "title", "description", "annex_reference", "risk_id", "user_id"],
+        "properties": {
+            field: {"bsonType": "string"}
+            for field in ("control_id", "title", "description", "annex_reference", "risk_id", "user_id")
+        },
+    }
+}
+
+# Mongo's DocumentValidationFailure code, reported for documents the
+# controls validator rejects
+DOCUMENT_VALIDATION_FAILURE = 121
+
+# Which risks have controls changes only when controls are saved, so the
+# distinct lookup is reused across a burst of risk listings
+RISK_IDS_CACHE_TTL = 5
+
+def failed_write_indexes(error: BulkWriteError) -> Tuple[set, set]:
+    """Split the batch indexes of an unordered insert_many failure into those
+    the controls validator rejected and those that failed for other reasons."""
+    rejected, failed = set(), set()
+    for write_error in error.details.get("writeErrors", []):
+        if write_error.get("code") == DOCUMENT_VALIDATION_FAILURE:
+            rejected.add(write_error["index"])
+        else:
+            failed.add(write_error["index"])
+    return rejected, failed
 
 def convert_objectid(obj):
     if isinstance(obj, dict):
@@ -14,6 +54,50 @@ def convert_objectid(obj):
     else:
         return obj
 
+def flatten_risk_doc(doc: Dict):
+    """Yield the risks in a finalized_risks document, each with a string `id`
+    and the owner's organization details. Documents without a `risks` list
+    are a single risk themselves."""
+    doc = convert_objectid(doc)
+
+    if "risks" in doc and isinstance(doc["risks"], list):
+        for risk in doc["risks"]:
+            risk = convert_objectid(risk)
+            risk["user_id"] = doc["user_id"]
+            risk["organization_name"] = doc.get("organization_name", "")
+            risk["location"] = doc.get("location", "")
+            risk["domain"] = doc.get("domain", "")
+
+            if "id" not in risk:
+                if "_id" in risk:
+                    risk["id"] = str(risk["_id"])
+                else:
+                    risk["id"] = str(doc.get("_id", ""))
+
+            if "_id" in risk:
+                del risk["_id"]
+
+            yield risk
+    else:
+        if "_id" in doc:
+            doc["id"] = str(doc["_id"])
+            del doc["_id"]
+        yield doc
+
+def risk_id_filter(risk_id: str) -> Dict:
+    """Match the finalized_risks documents that can contain `risk_id`, by the
+    same id rules flatten_risk_doc applies."""
+    ids = [risk_id, ObjectId(risk_id)] if ObjectId.is_valid(risk_id) else [risk_id]
+    return {"$or": [
+        {"risks.id": risk_id},
+        {"risks._id": {"$in": ids}},
+        {"_id": {"$in": ids}},
+        {"id": risk_id},
+    ]}
+
+def risk_category_filter(category: str) -> Dict:
+    return {"$or": [{"risks.category": category}, {"category": category}]}
+
 class MongoDBService:
     def __init__(self):
         self.client = MongoClient(MONGODB_URI)
@@ -22,81 +106,164 @@ class MongoDBService:
         self.risks = self.db[COLLECTIONS["risks"]]
         self.controls = self.db[COLLECTIONS["controls"]]
         self.sessions = self.db[COLLECTIONS["sessions"]]
+        self.pending_embeddings = self.db[COLLECTIONS["pending_embeddings"]]
+        # Async handles for the request path so reads and writes don't block
+        # the event loop; the agent and background jobs keep the sync client.
+        # A Motor client is bound to the loop it first runs on, so there is
+        # one per loop rather than one shared across them.
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
+        self._risk_ids_cache = {}
+        self._risk_ids_cache_lock = threading.Lock()
+        self.ensure_indexes()
+
+    @property
+    def async_client(self) -> AsyncIOMotorClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            with self._async_clients_lock:
+                client = self._async_clients.get(loop)
+                if client is None:
+                    client = AsyncIOMotorClient(MONGODB_URI, maxPoolSize=200, minPoolSize=10)
+                    self._async_clients[loop] = client
+        return client
+
+    @property
+    def async_db(self):
+        return self.async_client[DATABASE_NAME]
+
+    @property
+    def risks_async(self):
+        return self.async_db[COLLECTIONS["risks"]]
+
+    @property
+    def controls_async(self):
+        return self.async_db[COLLECTIONS["controls"]]
+
+    def ensure_indexes(self):
+        # Every per-user query filters on user_id first; the second key
+        # covers the risk and annex lookups. create_index is a no-op when
+        # the index already exists.
+        try:
+            self.controls.create_index([("user_id", 1), ("risk_id", 1)])
+            self.controls.create_index([("user_id", 1), ("annex_reference", 1)])
+            self.risks.create_index("user_id")
+        except Exception as e:
+            print(f"Could not create MongoDB indexes: {e}")
+        try:
+            self.ensure_control_validator()
+        except Exception as e:
+            print(f"Could not install the controls validator: {e}")
+        # Separate so pre-existing duplicate usernames only skip this index;
+        # signup falls back to an explicit existence check without it
+        try:
+            self.users.create_index("username", unique=True)
+            self.unique_usernames = True
+        except Exception as e:
+            self.unique_usernames = False
+            print(f"Could not create unique username index: {e}")
+
+    def ensure_control_validator(self):
+        # "moderate" leaves updates to pre-existing invalid documents alone
+        name = COLLECTIONS["controls"]
+        if name in self.db.list_collection_names():
+            self.db.command("collMod", name, validator=CONTROL_VALIDATOR, validationLevel="moderate")
+        else:
+            self.db.create_collection(name, validator=CONTROL_VALIDATOR, validationLevel="moderate")
 
     def get_user_context(self, user_id: str) -> Dict:
         return self.users.find_one({"username": user_id})
 
+    def _cached_risk_ids(self, user_id: str):
+        with self._risk_ids_cache_lock:
+            hit = self._risk_ids_cache.get(user_id)
+        if hit and time.monotonic() - hit[0] < RISK_IDS_CACHE_TTL:
+            return hit[1]
+        return None
+
+    def _cache_risk_ids(self, user_id: str, risk_ids: List) -> set:
+        risk_ids = set(str(rid) for rid in risk_ids)
+        with self._risk_ids_cache_lock:
+            if len(self._risk_ids_cache) >= 10000:
+                self._risk_ids_cache.clear()
+            self._risk_ids_cache[user_id] = (time.monotonic(), risk_ids)
+        return risk_ids
+
+    def invalidate_risk_ids_with_controls(self, user_id: str):
+        with self._risk_ids_cache_lock:
+            self._risk_ids_cache.pop(user_id, None)
+
     def get_user_risks(self, user_id: str, exclude_with_controls: bool = False) -> List[Dict]:
-        risk_docs = list(self.risks.find({"user_id": user_id}))
-        all_risks = []
-        
-        for doc in risk_docs:
-            doc = convert_objectid(doc)
-            
-            if "risks" in doc and isinstance(doc["risks"], list):
-                for risk in doc["risks"]:
-                    risk = convert_objectid(risk)
-                    risk["user_id"] = doc["user_id"]
-                    risk["organization_name"] = doc.get("organization_name", "")
-                    risk["location"] = doc.get("location", "")
-                    risk["domain"] = doc.get("domain", "")
-                    
-                    if "id" not in risk:
-                        if "_id" in risk:
-                            risk["id"] = str(risk["_id"])
-                        else:
-                            risk["id"] = str(doc.get("_id", ""))
-                    
-                    if "_id" in risk:
-                        del risk["_id"]
-                    
-                    all_risks.append(risk)
-            else:
-                if "_id" in doc:
-                    doc["id"] = str(doc["_id"])
-                    del doc["_id"]
-                all_risks.append(doc)
+        all_risks = [risk for doc in self.risks.find({"user_id": user_id}) for risk in flatten_risk_doc(doc)]
         
         if exclude_with_controls:
-            risk_ids_with_controls = set(str(rid) for rid in self.controls.distinct("risk_id", {"user_id": user_id}))
+            # Served by the (user_id, risk_id) index without touching documents
+            risk_ids_with_controls = self._cached_risk_ids(user_id)
+            if risk_ids_with_controls is None:
+                risk_ids_with_controls = self._cache_risk_ids(
+                    user_id, self.controls.distinct("risk_id", {"user_id": user_id}))
             all_risks = [r for r in all_risks if r.get("id") not in risk_ids_with_controls]
         
         return all_risks
 
+    async def aget_user_risks(self, user_id: str, exclude_with_controls: bool = False,
+                              category: Optional[str] = None) -> List[Dict]:
+        query = {"user_id": user_id}
+        if category:
+            query.update(risk_category_filter(category))
+        docs = await self.risks_async.find(query).to_list(length=None)
+        all_risks = [risk for doc in docs for risk in flatten_risk_doc(doc)]
+        if category:
+            # The filter selects whole documents; drop their other risks
+            all_risks = [r for r in all_risks if r.get("category") == category]
+
+        if exclude_with_controls:
+            risk_ids_with_controls = self._cached_risk_ids(user_id)
+            if risk_ids_with_controls is None:
+                risk_ids_with_controls = self._cache_risk_ids(
+                    user_id, await self.controls_async.distinct("risk_id", {"user_id": user_id}))
+            all_risks = [r for r in all_risks if r.get("id") not in risk_ids_with_controls]
+
+        return all_risks
+
     def get_risk_by_id(self, risk_id: str, user_id: str) -> Optional[Dict]:
-        risk_docs = list(self.risks.find({"user_id": user_id}))
-        
-        for doc in risk_docs:
-            doc = convert_objectid(doc)
-            
-            if "risks" in doc and isinstance(doc["risks"], list):
-                for risk in doc["risks"]:
-                    risk = convert_objectid(risk)
-                    
-                    risk_current_id = risk.get("id", str(risk.get("_id", "")))
-                    
-                    if risk_current_id == risk_id:
-                        risk["user_id"] = doc["user_id"]
-                        risk["organization_name"] = doc.get("organization_name", "")
-                        risk["location"] = doc.get("location", "")
-                        risk["domain"] = doc.get("domain", "")
-                        
-                        if "id" not in risk:
-                            risk["id"] = risk_current_id
-                        
-                        if "_id" in risk:
-                            del risk["_id"]
-                        
-                        return risk
-            else:
-                if str(doc.get("_id", "")) == risk_id:
-                    if "_id" in doc:
-                        doc["id"] = str(doc["_id"])
-                        del doc["_id"]
-                    return doc
-        
+        for doc in self.risks.find({"user_id": user_id, **risk_id_filter(risk_id)}):
+            for risk in flatten_risk_doc(doc):
+                if risk["id"] == risk_id:
+                    return risk
+        return None
+
+    async def aget_risk_by_id(self, risk_id: str, user_id: str) -> Optional[Dict]:
+        async for doc in self.risks_async.find({"user_id": user_id, **risk_id_filter(risk_id)}):
+            for risk in flatten_risk_doc(doc):
+                if risk["id"] == risk_id:
+                    return risk
         return None
 
+    def get_risk_with_controls(self, risk_id: str, user_id: str) -> Tuple[Optional[Dict], List[Dict]]:
+        """Fetch a risk and its controls in one round trip. The controls are
+        unioned onto the risk document that holds `risk_id` and tagged so the
+        two can be told apart in the combined cursor."""
+        pipeline = [
+            {"$match": {"user_id": user_id, **risk_id_filter(risk_id)}},
+            {"$unionWith": {
+                "coll": self.controls.name,
+                "pipeline": [
+                    {"$match": {"risk_id": risk_id, "user_id": user_id}},
+                    {"$addFields": {"_from_controls": True}},
+                ],
+            }},
+        ]
+        risk = None
+        controls = []
+        for doc in self.risks.aggregate(pipeline):
+            if doc.pop("_from_controls", False):
+                controls.append(doc)
+            elif risk is None:
+                risk = next((r for r in flatten_risk_doc(doc) if r["id"] == risk_id), None)
+        return risk, controls
+
     def get_controls_by_risk(self, risk_id: str, user_id: str) -> List[Dict]:
         return list(self.controls.find({"risk_id": risk_id, "user_id": user_id}))
 
@@ -106,14 +273,27 @@ class MongoDBService:
         return list(self.controls.find({"risk_id": {"$in": risk_ids}, "user_id": user_id}))
 
     def get_controls_by_annex(self, annex: str, user_id: str) -> List[Dict]:
-        return list(self.controls.find({"annex_reference": {"$regex": f"^{annex}"}, "user_id": user_id}))
+        # Escaped so the dots in "A.5" match literally and the anchored prefix
+        # bounds the annex_reference index scan
+        return list(self.controls.find({"annex_reference": {"$regex": f"^{re.escape(annex)}"}, "user_id": user_id}))
 
     def save_controls(self, controls: List[Dict]) -> List[str]:
+        # One timestamp for the batch so controls saved together sort together
+        now = datetime.now(timezone.utc)
         control_ids = []
         for control in controls:
             control["_id"] = str(uuid.uuid4())
+            control.setdefault("created_at", now)
             control_ids.append(control["_id"])
-            self.controls.insert_one(control)
+        try:
+            if controls:
+                # One round trip for the batch; ids are generated client-side so
+                # an unordered insert can't collide on _id
+                self.controls.insert_many(controls, ordered=False)
+        finally:
+            # A BulkWriteError still leaves the valid documents inserted
+            for user_id in {control.get("user_id") for control in controls}:
+                self.invalidate_risk_ids_with_controls(user_id)
         return control_ids
 
     def save_session(self, session_data: Dict) -> str:
@@ -1,10 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from langgraph.graph import StateGraph, END
-from typing import Dict, List, Optional
+from pymongo.errors import BulkWriteError
+from starlette.concurrency import iterate_in_threadpool
+from typing import AsyncIterator, Dict, List, Optional
 from .models import AgentState
 from .openai_service import openai_service
-from .database import mongodb
+from .database import mongodb, failed_write_indexes
 from .neo4j_db import neo4j_service
 from .postgres import postgres_service
+from .rag_service import rag_service
 import uuid
 
 class DatabaseTools:
@@ -79,7 +83,7 @@ class DatabaseTools:
         try:
             if not query.strip():
                 return []
-            query_embedding = self.openai.get_embedding(query)
+            query_embedding = rag_service.get_query_embedding(query)
             result = self.postgres.search_similar_controls(query_embedding, limit=limit)
             return result
         except Exception as e:
@@ -90,7 +94,7 @@ class DatabaseTools:
         try:
             if not query.strip():
                 return []
-            query_embedding = self.openai.get_embedding(query)
+            query_embedding = rag_service.get_query_embedding(query)
             result = self.postgres.get_iso_guidance(query_embedding, limit=limit)
             return result
         except Exception as e:
@@ -111,6 +115,9 @@ class ISO27001Agent:
         self.graph_db = neo4j_service
         self.db_tools = DatabaseTools()
         self.postgres = postgres_service
+        # Mongo and Neo4j writes for a selection are independent, so they
+        # run side by side rather than one after the other
+        self.store_executor = ThreadPoolExecutor(max_workers=4)
         self.workflow = self._build_workflow()
 
     def _build_workflow(self):
@@ -355,41 +362,64 @@ class ISO27001Agent:
 
     def store_data_node(self, state: AgentState) -> AgentState:
         if state["selected_controls"]:
+            selected_ids = set(state["selected_controls"])
             controls_to_store = [
                 control for control in state["generated_controls"]
-                if control["id"] in state["selected_controls"]
+                if control["id"] in selected_ids
             ]
             
+            graph_future = self.store_executor.submit(self.graph_db.create_control_nodes_bulk, controls_to_store)
             try:
-                # Store in MongoDB
-                self.mongo.save_controls(controls_to_store)
-                
-                # Store in Neo4j
-                for control in controls_to_store:
-                    self.graph_db.create_control_node(control)
+                # MongoDB is the system of record; the embedding job marks
+                # the saved documents, so it waits for this write
+                try:
+                    self.mongo.save_controls(controls_to_store)
+                    stored = controls_to_store
+                except BulkWriteError as e:
+                    # The insert is unordered, so every document without a
+                    # write error was still saved
+                    rejected, failed = failed_write_indexes(e)
+                    stored = [control for i, control in enumerate(controls_to_store)
+                              if i not in rejected and i not in failed]
+                    if failed:
+                        errmsg = next(err.get("errmsg") for err in e.details["writeErrors"] if err["index"] in failed)
+                        print(f"Failed to save {len(failed)} controls of user {state['user_id']}: {errmsg}")
                 
                 # Store embeddings
-                for control in controls_to_store:
-                    embedding_text = f"{control['title']} {control['description']}"
-                    embedding = self.openai.get_embedding(embedding_text)
-                    self.postgres.store_control_embedding(
-                        control['id'],
-                        control['user_id'],
-                        control['title'],
-                        control['description'],
-                        control['annex_reference'],
-                        embedding
-                    )
+                if stored:
+                    rag_service.store_control_embeddings(stored)
+                    rag_service.invalidate_user_context(state["user_id"])
                 
-                state["final_response"] = f"Successfully saved {len(controls_to_store)} controls."
+                if len(stored) == len(controls_to_store):
+                    state["final_response"] = f"Successfully saved {len(stored)} controls."
+                else:
+                    problems = []
+                    if rejected:
+                        problems.append(f"{len(rejected)} were rejected as incomplete")
+                    if failed:
+                        problems.append(f"{len(failed)} could not be saved")
+                    state["final_response"] = (
+                        f"Saved {len(stored)} of {len(controls_to_store)} controls; {' and '.join(problems)}."
+                    )
                 
             except Exception as e:
                 state["final_response"] = f"Error saving controls: {str(e)}"
+
+            # The graph can be rebuilt from MongoDB via /kg/initialize-user,
+            # so a failed sync is reported without failing the save
+            try:
+                graph_future.result()
+            except Exception as e:
+                print(f"Neo4j sync failed for {len(controls_to_store)} controls of user {state['user_id']}: {e}")
         
         return state
 
     def synthesize_response_node(self, state: AgentState) -> AgentState:
         
+        # Streaming callers generate the text themselves once the graph is done
+        if state.get("stream_response") and not state.get("final_response"):
+            return state
+
         if not state.get("final_response"):
             try:
                 state["final_response"] = self.openai.synthesize_response(
@@ -398,15 +428,7 @@ class ISO27001Agent:
                     state.get("generated_controls")
                 )
             except Exception as e:
-                # Fallback response
-                if state.get("generated_controls"):
-                    count = len(state["generated_controls"])
-                    state["final_response"] = f"I've generated {count} controls for your risks. Please review and select the ones you'd like to implement."
-                elif state.get("retrieved_context", {}).get("risks"):
-                    count = len(state["retrieved_context"]["risks"])
-                    state["final_response"] = f"I found {count} risks in your system."
-                else:
-                    state["final_response"] = "I've processed your request. Please check the results."
+                state["final_response"] = self._fallback_response(state)
         
         # Ensure we always have some response
         if not state.get("final_response"):
@@ -414,6 +436,15 @@ class ISO27001Agent:
             
         return state
 
+    def _fallback_response(self, state: Dict) -> str:
+        if state.get("generated_controls"):
+            count = len(state["generated_controls"])
+            return f"I've generated {count} controls for your risks. Please review and select the ones you'd like to implement."
+        elif state.get("retrieved_context", {}).get("risks"):
+            count = len(state["retrieved_context"]["risks"])
+            return f"I found {count} risks in your system."
+        return "I've processed your request. Please check the results."
+
     def route_after_classification(self, state: AgentState) -> str:
         intent = state["intent"]
         if intent.startswith("generate_controls") or intent.startswith("show_"):
@@ -433,7 +464,8 @@ class ISO27001Agent:
             return "store"
         return "wait"
 
-    async def run(self, user_query: str, user_id: str, selected_controls: list = None, session_id: str = None):
+    async def run(self, user_query: str, user_id: str, selected_controls: list = None, session_id: str = None,
+                  stream_response: bool = False):
         
         try:
             user_context = self.mongo.get_user_context(user_id)
@@ -446,6 +478,7 @@ class ISO27001Agent:
                 if session_data:
                     state = session_data["state"]
                     state["selected_controls"] = selected_controls
+                    state["stream_response"] = stream_response
                     result = await self.workflow.ainvoke(state, {"recursion_limit": 10})
                     return result
             except Exception as e:
@@ -463,7 +496,8 @@ class ISO27001Agent:
             "conversation_history": [],
             "final_response": "",
             "pending_selection": False,
-            "session_id": ""
+            "session_id": "",
+            "stream_response": stream_response
         }
         
         
@@ -478,4 +512,39 @@ class ISO27001Agent:
                 "session_id": ""
             }
 
+    async def stream(self, user_query: str, user_id: str) -> AsyncIterator[Dict]:
+        """Run the agent and stream the final response text.
+
+        Yields {"type": "token", "content": ...} events while the response is
+        generated, then one {"type": "done", ...} event with the controls and
+        session the non-streaming endpoint returns.
+        """
+        result = await self.run(user_query, user_id, stream_response=True)
+        response = result.get("final_response", "")
+
+        if response:
+            yield {"type": "token", "content": response}
+        else:
+            try:
+                chunks = self.openai.stream_response(
+                    result["user_query"],
+                    result["retrieved_context"],
+                    result.get("generated_controls")
+                )
+                async for chunk in iterate_in_threadpool(chunks):
+                    response += chunk
+                    yield {"type": "token", "content": chunk}
+            except Exception as e:
+                if not response:
+                    response = self._fallback_response(result)
+                    yield {"type": "token", "content": response}
+
+        yield {
+            "type": "done",
+            "response": response or "Request processed successfully.",
+            "controls": result.get("generated_controls", []),
+            "pending_selection": result.get("pending_selection", False),
+            "session_id": result.get("session_id", "")
+        }
+
 iso_agent = ISO27001Agent()
\ No newline at end of file
@@ -1,8 +1,32 @@
-from fastapi import FastAPI
+import logging
+import anyio
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from .routers import auth, controls, risks, search, kg
+from .rag_service import rag_service
+from .langgraph_agent import iso_agent
+from .openai_service import openai_service
+from .postgres import postgres_service
+from .config import POSTGRES_POOL_MAX_SIZE
 
-app = FastAPI(title="ISO 27001 Control Agent", version="1.0.0")
+# orjson serializes the large control and risk listings several times
+# faster than the stdlib encoder
+app = FastAPI(title="ISO 27001 Control Agent", version="1.0.0", default_response_class=ORJSONResponse)
+
+logger = logging.getLogger(__name__)
+
+# Registered before CORSMiddleware so it runs inside it and the 500 still
+# carries the CORS headers the frontend needs to read `detail`. HTTPExceptions
+# are turned into responses further in and keep their own status; anything
+# else is logged once here and reported without leaking internals.
+@app.middleware("http")
+async def unhandled_exception(request: Request, call_next):
+    try:
+        return await call_next(request)
+    except Exception:
+        logger.exception("Unhandled error on %s %s", request.method, request.url.path)
+        return ORJSONResponse(status_code=500, content={"detail": "Internal server error"})
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,6 +42,36 @@ app.include_router(risks.router, prefix="/risks", tags=["risks"])
 app.include_router(search.router, prefix="/search", tags=["search"])
 app.include_router(kg.router, prefix="/kg", tags=["knowledge-graph"])
 
+# Endpoints backed by the sync Postgres, Neo4j and OpenAI clients are plain
+# def handlers, which FastAPI runs on this threadpool (40 threads by default).
+# Most of these threads wait on network I/O, so allow well beyond that. A
+# search fans out to up to three pooled Postgres connections; threads that
+# find the pool exhausted wait at most POOL_TIMEOUT for one, and larger pools
+# raise the limit past the floor.
+THREADPOOL_SIZE = max(100, 4 * POSTGRES_POOL_MAX_SIZE)
+
+@app.on_event("startup")
+async def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+@app.on_event("startup")
+def replay_pending_embeddings():
+    # Re-queue control embeddings that were accepted but not stored before
+    # the last shutdown
+    try:
+        rag_service.replay_pending_embeddings()
+    except Exception as e:
+        print(f"Could not replay pending embeddings: {e}")
+
+@app.on_event("shutdown")
+def close_services():
+    # Drain the background writers before closing the Postgres pool they use
+    iso_agent.store_executor.shutdown(wait=True)
+    auth.graph_executor.shutdown(wait=True)
+    rag_service.close()
+    openai_service.embedding_batcher.close()
+    postgres_service.close()
+
 @app.get("/")
 async def root():
     return {"message": "ISO 27001 Control Generation Agent"}
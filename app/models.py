@@ -1,5 +1,5 @@
 from typing import Dict, List, Optional, TypedDict, Literal
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, ValidationError
 from datetime import datetime
 
 class AgentState(TypedDict):
@@ -15,6 +15,7 @@ class AgentState(TypedDict):
     final_response: str
     pending_selection: bool
     session_id: str
+    stream_response: bool
 
 class FinalizedRisk(BaseModel):
     id: Optional[str] = None
@@ -46,6 +47,29 @@ class Control(BaseModel):
     user_id: str
     created_at: Optional[datetime] = None
 
+class GeneratedControl(BaseModel):
+    """The fields the LLM must return for each generated control."""
+    # Stripped before the length check, so blank values count as missing
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True, str_min_length=1)
+
+    control_id: str
+    title: str
+    description: str
+    domain_category: str
+    annex_reference: str
+    control_statement: str
+    implementation_guidance: str
+
+def validate_generated_controls(controls: List) -> List[Dict]:
+    """Keep the well-formed controls from an LLM response, as plain dicts."""
+    validated = []
+    for control in controls:
+        try:
+            validated.append(GeneratedControl.model_validate(control).model_dump())
+        except ValidationError:
+            continue
+    return validated
+
 class ControlSelection(BaseModel):
     session_id: str
     selected_control_ids: List[str]
@@ -33,6 +33,27 @@ class Neo4jService:
                 MERGE (u)-[:HAS_RISK]->(r)
             """, **risk_data)
 
+    def create_risk_nodes_bulk(self, risks: List[Dict]):
+        """Create or update many risk nodes and their owners' relationships in
+        a single round trip."""
+        if not risks:
+            return
+        fields = ("id", "description", "category", "likelihood", "impact", "user_id")
+        rows = [{field: risk.get(field) for field in fields} for risk in risks]
+        with self.driver.session() as session:
+            session.run("""
+                UNWIND $rows AS row
+                MERGE (r:Risk {id: row.id})
+                SET r.description = row.description,
+                    r.category = row.category,
+                    r.likelihood = row.likelihood,
+                    r.impact = row.impact,
+                    r.user_id = row.user_id
+                WITH r, row
+                MATCH (u:User {id: row.user_id})
+                MERGE (u)-[:HAS_RISK]->(r)
+            """, rows=rows)
+
     def create_control_node(self, control_data: Dict):
         with self.driver.session() as session:
             session.run("""
@@ -51,6 +72,32 @@ class Neo4jService:
                 MERGE (c)-[:MITIGATES]->(r)
             """, **control_data)
 
+    def create_control_nodes_bulk(self, controls: List[Dict]):
+        """Create or update many control nodes and their relationships in a
+        single round trip."""
+        if not controls:
+            return
+        fields = ("id", "control_id", "title", "description", "domain_category",
+                  "annex_reference", "user_id", "risk_id")
+        rows = [{field: control.get(field) for field in fields} for control in controls]
+        with self.driver.session() as session:
+            session.run("""
+                UNWIND $rows AS row
+                MERGE (c:Control {id: row.id})
+                SET c.control_id = row.control_id,
+                    c.title = row.title,
+                    c.description = row.description,
+                    c.domain_category = row.domain_category,
+                    c.annex_reference = row.annex_reference,
+                    c.user_id = row.user_id,
+                    c.risk_id = row.risk_id
+                WITH c, row
+                MATCH (u:User {id: row.user_id})
+                MATCH (r:Risk {id: row.risk_id})
+                MERGE (u)-[:SELECTED_CONTROL]->(c)
+                MERGE (c)-[:MITIGATES]->(r)
+            """, rows=rows)
+
     def get_similar_controls_by_domain(self, domain: str, risk_category: str) -> List[Dict]:
         with self.driver.session() as session:
             result = session.run("""
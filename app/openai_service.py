@@ -1,9 +1,19 @@
 import openai
-from typing import List, Dict
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, List, Dict
+import queue
 import re
 import json
+import logging
+import threading
+import time
 from .config import OPENAI_API_KEY
+from .models import validate_generated_controls
 import os
+
+logger = logging.getLogger(__name__)
+
 # Load annex JSON file
 ANNEX_JSON_PATH = os.path.join(os.path.dirname(__file__), '..', 'annex.json')
 try:
@@ -12,18 +22,100 @@ try:
 except FileNotFoundError:
     annex_data = {}
 
+# The guidance is the same for every control-generation prompt, so it is
+# serialized once here rather than per risk
+ANNEX_GUIDANCE_TEXT = json.dumps(annex_data, indent=2)
+
 openai.api_key = OPENAI_API_KEY
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+class EmbeddingBatcher:
+    """Coalesce concurrent single-text embedding requests into batched calls.
+
+    Callers block in `embed` while a collector thread gathers whatever else
+    arrives within `max_wait` seconds (up to `max_batch` texts) and sends it
+    as one request, so concurrent searches share an OpenAI round trip.
+    """
+
+    def __init__(self, service: "OpenAIService", max_batch: int = 64, max_wait: float = 0.01,
+                 timeout: float = 30):
+        self.service = service
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        # Batches are sent from a pool so the collector keeps gathering the
+        # next batch while one is in flight
+        self._senders = ThreadPoolExecutor(max_workers=4)
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def close(self):
+        self._senders.shutdown(wait=True)
+
+    def embed(self, text: str) -> np.ndarray:
+        # The API rejects empty input, which would fail every text batched with it
+        if not text or not text.strip():
+            raise ValueError("Cannot embed empty text")
+        future = Future()
+        self._queue.put((text, future))
+        return future.result(timeout=self.timeout)
+
+    def _collect(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._senders.submit(self._send, items)
+
+    def _send(self, items):
+        try:
+            embeddings = self.service.get_embeddings_batch([text for text, _ in items], batch_size=self.max_batch)
+        except Exception as e:
+            if len(items) == 1:
+                items[0][1].set_exception(e)
+                return
+            # Don't let one bad text fail the unrelated requests batched with it
+            for text, future in items:
+                try:
+                    future.set_result(self.service.get_embedding(text))
+                except Exception as item_error:
+                    future.set_exception(item_error)
+            return
+        for (_, future), embedding in zip(items, embeddings):
+            future.set_result(embedding)
+
 class OpenAIService:
     def __init__(self):
         self.client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        self.embedding_batcher = EmbeddingBatcher(self)
 
-    def get_embedding(self, text: str) -> List[float]:
+    def get_embedding(self, text: str) -> np.ndarray:
         response = self.client.embeddings.create(
-            model="text-embedding-ada-002",
+            model=EMBEDDING_MODEL,
             input=text
         )
-        return response.data[0].embedding
+        return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+    def get_embeddings_batch(self, texts: List[str], batch_size: int = 128) -> np.ndarray:
+        # The embeddings endpoint accepts up to 2048 inputs per request, so one
+        # round-trip covers a whole batch instead of one per text
+        embeddings = []
+        for i in range(0, len(texts), batch_size):
+            response = self.client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts[i:i + batch_size]
+            )
+            embeddings.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        # One (N, dim) float32 matrix, so similarity over the batch is a single matrix product
+        return np.asarray(embeddings, dtype=np.float32)
 
     def classify_intent(self, query: str, user_context: Dict) -> Dict:
         # Heuristic-first routing for robustness
@@ -133,7 +225,7 @@ Organization: {user_context.get('organization_name', '')}, Domain: {user_context
         - Location: {user_context.get('location', '')}
 
         ISO 27001:2022 Annex A Guidance:
-        {json.dumps(annex_data, indent=2)}
+        {ANNEX_GUIDANCE_TEXT}
         """
         
         prompt = f"""
@@ -170,17 +262,27 @@ Organization: {user_context.get('organization_name', '')}, Domain: {user_context
         
         try:
             content = response.choices[0].message.content
-            return json.loads(content)
+            controls = json.loads(content)
         except Exception as e:
             return []
+        if not isinstance(controls, list):
+            return []
 
-    def synthesize_response(self, query: str, context: Dict, controls: List[Dict] = None) -> str:   
+        # Incomplete controls would otherwise fail AgentResponse validation
+        # and turn the whole chat request into a 500
+        validated = validate_generated_controls(controls)
+        if len(validated) < len(controls):
+            logger.warning("Dropped %d of %d generated controls with missing fields",
+                           len(controls) - len(validated), len(controls))
+        return validated
+
+    def _synthesis_prompt(self, query: str, context: Dict, controls: List[Dict] = None) -> str:
         if controls:
             controls_text = f"Generated {len(controls)} controls for selection."
         else:
             controls_text = json.dumps(context, default=str, indent=2)
         
-        prompt = f"""
+        return f"""
         User Query: {query}
         Context/Results: {controls_text}
         
@@ -188,13 +290,26 @@ Organization: {user_context.get('organization_name', '')}, Domain: {user_context
         If controls were generated, mention that they can select from the options.
         Keep response concise and professional.
         """
-        
+
+    def synthesize_response(self, query: str, context: Dict, controls: List[Dict] = None) -> str:   
         response = self.client.chat.completions.create(
             model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
+            messages=[{"role": "user", "content": self._synthesis_prompt(query, context, controls)}],
             temperature=0.3
         )
         
         return response.choices[0].message.content
 
+    def stream_response(self, query: str, context: Dict, controls: List[Dict] = None) -> Iterator[str]:
+        """Same as synthesize_response, but yields the text as it is generated."""
+        stream = self.client.chat.completions.create(
+            model="gpt-4",
+            messages=[{"role": "user", "content": self._synthesis_prompt(query, context, controls)}],
+            temperature=0.3,
+            stream=True
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
 openai_service = OpenAIService()
\ No newline at end of file
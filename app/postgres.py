@@ -1,23 +1,318 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import functools
+import hashlib
+import inspect
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from pgvector.psycopg2 import register_vector
 import numpy as np
-from typing import List, Dict, Tuple
-from .config import POSTGRES_URI
+from typing import Callable, List, Dict, Tuple, Literal, Optional
+from .config import (
+    POSTGRES_URI, POSTGRES_POOL_MIN_SIZE, POSTGRES_POOL_MAX_SIZE,
+    POSTGRES_INDEX_KIND, POSTGRES_MAINTENANCE_WORK_MEM, POSTGRES_PREWARM,
+    POSTGRES_BRUTE_FORCE_MAX_ROWS
+)
+
+logger = logging.getLogger(__name__)
+
+IndexKind = Literal["hnsw", "ivfflat"]
+
+# HNSW parameters by table size (upper row bound, params). Small tables keep
+# the pgvector defaults; larger graphs get more links and a wider search so
+# recall stays >= 0.99 while build cost grows with the data.
+HNSW_BUCKETS = [
+    (100_000, {"m": 16, "ef_construction": 64, "ef_search": 40}),
+    (1_000_000, {"m": 24, "ef_construction": 100, "ef_search": 100}),
+    (None, {"m": 32, "ef_construction": 128, "ef_search": 200}),
+]
+HNSW_BUILD_WORKERS = 7
+
+# IVFFlat trades recall for a much smaller footprint than HNSW's graph
+# (roughly 2-3x the raw vector bytes). Only `probes` of the `lists`
+# partitions are scanned per query. `lists` is sized to about sqrt(rows);
+# the centroids are fixed when the index is built, so it is rebuilt once that
+# target has drifted IVFFLAT_LISTS_DRIFT-fold from the built list count.
+IVFFLAT_MIN_LISTS = 10
+IVFFLAT_LISTS_DRIFT = 2
+IVFFLAT_PROBES = 10
+
+# Half-precision storage halves the bytes read per distance computation
+# (distance scans are memory-bandwidth bound) and the index size, at a
+# negligible recall cost for 1536-d embeddings. Requires pgvector >= 0.7.
+EMBEDDING_TYPE = "halfvec(1536)"
+# Vectors are stored unit-length, so the negative inner product (<#>) ranks
+# exactly like cosine distance without the per-comparison norm computations
+EMBEDDING_OPCLASS = "halfvec_ip_ops"
+EMBEDDING_TABLES = ("risk_embeddings", "control_embeddings", "iso_guidance_embeddings", "query_embeddings")
+
+VECTOR_INDEXES = {
+    "risk_embeddings": "risk_embedding_idx",
+    "control_embeddings": "control_embedding_idx",
+    "iso_guidance_embeddings": "iso_guidance_embedding_idx",
+}
+
+# Hot search statements, prepared once per pooled connection so repeated
+# searches skip parse and plan. $1 is referenced twice but bound once.
+SEARCH_STATEMENTS = {
+    "search_risks": """
+        PREPARE search_risks(halfvec, int) AS
+        SELECT risk_id, user_id, description, category,
+               -(embedding <#> $1) as similarity
+        FROM risk_embeddings
+        ORDER BY embedding <#> $1
+        LIMIT $2
+    """,
+    "search_controls": """
+        PREPARE search_controls(halfvec, int) AS
+        SELECT control_id, user_id, title, description, annex_reference,
+               -(embedding <#> $1) as similarity
+        FROM control_embeddings
+        ORDER BY embedding <#> $1
+        LIMIT $2
+    """,
+    # Materialize the annex matches first so distances are only computed
+    # for candidate rows, not across the whole table
+    "search_controls_by_annex": """
+        PREPARE search_controls_by_annex(text, halfvec, int) AS
+        WITH candidates AS MATERIALIZED (
+            SELECT control_id, user_id, title, description, annex_reference, embedding
+            FROM control_embeddings
+            WHERE annex_reference LIKE $1
+        )
+        SELECT control_id, user_id, title, description, annex_reference,
+               -(embedding <#> $2) as similarity
+        FROM candidates
+        ORDER BY embedding <#> $2
+        LIMIT $3
+    """,
+    # Broad filters: let the ANN index walk in distance order and drop
+    # non-matching rows as it goes
+    "search_controls_by_annex_ann": """
+        PREPARE search_controls_by_annex_ann(text, halfvec, int) AS
+        SELECT control_id, user_id, title, description, annex_reference,
+               -(embedding <#> $2) as similarity
+        FROM control_embeddings
+        WHERE annex_reference LIKE $1
+        ORDER BY embedding <#> $2
+        LIMIT $3
+    """,
+    # The three general-query lookups fused into one round trip, tagged by source
+    "search_all": """
+        PREPARE search_all(halfvec, int, int, int, text) AS
+        (WITH candidates AS MATERIALIZED (
+             SELECT control_id, user_id, title, description, annex_reference, embedding
+             FROM control_embeddings
+             WHERE user_id = $5
+         )
+         SELECT 'control' AS tag, control_id AS item_id, user_id, title, description,
+                NULL AS category, annex_reference, NULL AS guidance_text,
+                -(embedding <#> $1) as similarity
+         FROM candidates
+         ORDER BY embedding <#> $1
+         LIMIT $2)
+        UNION ALL
+        (SELECT 'risk', risk_id, user_id, NULL, description,
+                category, NULL, NULL,
+                -(embedding <#> $1)
+         FROM risk_embeddings
+         ORDER BY embedding <#> $1
+         LIMIT $3)
+        UNION ALL
+        (SELECT 'iso', NULL, NULL, NULL, NULL,
+                NULL, annex_reference, guidance_text,
+                -(embedding <#> $1)
+         FROM iso_guidance_embeddings
+         ORDER BY embedding <#> $1
+         LIMIT $4)
+    """,
+    "search_iso_guidance": """
+        PREPARE search_iso_guidance(halfvec, int) AS
+        SELECT annex_reference, guidance_text,
+               -(embedding <#> $1) as similarity
+        FROM iso_guidance_embeddings
+        ORDER BY embedding <#> $1
+        LIMIT $2
+    """,
+    # Row fetch for the in-memory lanes, which rank controls client-side
+    "fetch_controls": """
+        PREPARE fetch_controls(text[]) AS
+        SELECT control_id, user_id, title, description, annex_reference
+        FROM control_embeddings WHERE control_id = ANY($1)
+    """,
+}
+
+
+# Small control tables are searched by a linear scan over int8-quantized
+# vectors held in process memory: no graph traversal and sequential memory
+# access beat HNSW below a few tens of thousands of rows. The snapshot is
+# reloaded after this many seconds or after a local write.
+SQ8_CACHE_TTL = 60
+# Per-user control matrices for user-scoped searches on tables too large for
+# the snapshot above: a user's controls are few, so one float32 GEMV over a
+# cached float16 matrix replaces the filtered scan in Postgres
+USER_MATRIX_CACHE_SIZE = 256
+
+# Rows per round trip when streaming full-table scans through a server-side
+# cursor, instead of materializing the whole result client-side
+SCAN_ITERSIZE = 1000
+
+# Results of recent searches, keyed on the exact query vector and arguments.
+# Any embedding write clears the cache, so the TTL only bounds staleness from
+# writes made by other processes.
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_SIZE = 2000
+
+
+def as_vector(embedding) -> np.ndarray:
+    """Coerce an embedding to a unit-length float32 array."""
+    v = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm else v
+
+
+def quantize_sq8(embedding) -> Tuple[np.ndarray, float]:
+    """Quantize to int8 with a per-vector scale that also folds in the norm,
+    so scale_a * scale_b * dot(q_a, q_b) approximates cosine similarity."""
+    v = as_vector(embedding)
+    peak = float(np.abs(v).max()) or 1.0
+    q = np.clip(np.rint(v * (127 / peak)), -127, 127).astype(np.int8)
+    return q, peak / 127 / (float(np.linalg.norm(v)) or 1.0)
+
+# How long a request waits for a free pooled connection before giving up
+POOL_TIMEOUT = 30
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool whose getconn waits for a connection to be
+    returned instead of raising PoolError once all maxconn are checked out."""
+    def __init__(self, minconn, maxconn, *args, timeout: float = POOL_TIMEOUT, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f"no connection available after {self.timeout}s")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+def copy_rows(result):
+    # Callers annotate result rows in place, so never hand out cached rows
+    if isinstance(result, dict):
+        return {name: [dict(row) for row in rows] for name, rows in result.items()}
+    return [dict(row) for row in result]
+
+def cached_search(method):
+    """Serve repeat calls of a search method from PostgresVectorService's
+    result cache. Empty results are not cached, since failed searches
+    return [] as well."""
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, query_embedding, *args, **kwargs):
+        if not self.pool:
+            return method(self, query_embedding, *args, **kwargs)
+        # Bound with defaults applied, so positional, keyword and defaulted
+        # spellings of the same call share an entry
+        bound = signature.bind(self, query_embedding, *args, **kwargs)
+        bound.apply_defaults()
+        params = tuple(bound.arguments.items())[2:]
+        digest = hashlib.sha256(as_vector(query_embedding).tobytes()).digest()
+        key = (method.__name__, digest, params)
+        now = time.monotonic()
+        with self._search_cache_lock:
+            hit = self._search_cache.get(key)
+            if hit and now - hit[0] < SEARCH_CACHE_TTL:
+                self._search_cache.move_to_end(key)
+                self._search_cache_hits += 1
+                return copy_rows(hit[1])
+            self._search_cache_misses += 1
+            generation = self._search_cache_generation
+
+        result = method(self, query_embedding, *args, **kwargs)
+        if result and (not isinstance(result, dict) or any(result.values())):
+            with self._search_cache_lock:
+                # Skip results that raced with a write
+                if generation == self._search_cache_generation:
+                    self._search_cache[key] = (now, copy_rows(result))
+                    self._search_cache.move_to_end(key)
+                    while len(self._search_cache) > SEARCH_CACHE_SIZE:
+                        self._search_cache.popitem(last=False)
+        return result
+    return wrapper
 
 class PostgresVectorService:
     def __init__(self):
+        self.index_kind: IndexKind = POSTGRES_INDEX_KIND
+        self._hnsw_params: Dict[str, Dict[str, int]] = {}
+        self._cached_query_embedding = functools.lru_cache(maxsize=10000)(self._load_query_embedding)
+        self._configured = weakref.WeakSet()
+        self._prepared = weakref.WeakKeyDictionary()
+        self._annex_fractions: Dict[str, float] = {}
+        self._sq8_lock = threading.Lock()
+        self._sq8_snapshot: Optional[Dict] = None
+        self._sq8_loaded_at = float("-inf")
+        self._user_matrices = OrderedDict()
+        self._user_matrices_lock = threading.Lock()
+        self._search_cache = OrderedDict()
+        self._search_cache_lock = threading.Lock()
+        self._search_cache_generation = 0
+        self._search_cache_hits = 0
+        self._search_cache_misses = 0
+        # Query-embedding inserts are off the request path; one worker keeps
+        # them from competing with searches for pooled connections
+        self._write_executor = ThreadPoolExecutor(max_workers=1)
         try:
             if not POSTGRES_URI:
-                self.conn = None
+                self.pool = None
                 return
-            self.conn = psycopg2.connect(POSTGRES_URI)
+            self.pool = BlockingConnectionPool(POSTGRES_POOL_MIN_SIZE, POSTGRES_POOL_MAX_SIZE, POSTGRES_URI)
             self.create_tables()
         except Exception as e:
-            self.conn = None
+            logger.warning("Postgres vector store unavailable: %s", e)
+            self.pool = None
+
+    def close(self):
+        self._write_executor.shutdown(wait=True)
+        if self.pool:
+            self.pool.closeall()
 
-    def create_tables(self):
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled autocommit connection with the pgvector types registered."""
+        conn = self.pool.getconn()
         try:
-            with self.conn.cursor() as cur:
+            if conn not in self._configured:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    # register_vector looks up the pgvector type OIDs, so the
+                    # extension must exist before the first connection is set up
+                    cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+                register_vector(conn)
+                self._configured.add(conn)
+            yield conn
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    def create_tables(self, index_kind: Optional[IndexKind] = None):
+        if index_kind:
+            self.index_kind = index_kind
+        try:
+            with self.connection() as conn, conn.cursor() as cur:
                 # Create extension first
                 cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
                 
@@ -29,7 +324,7 @@ class PostgresVectorService:
                         user_id VARCHAR(255),
                         description TEXT,
                         category VARCHAR(255),
-                        embedding vector(1536)
+                        embedding halfvec(1536)
                     );
                 """)
                 
@@ -41,7 +336,7 @@ class PostgresVectorService:
                         title TEXT,
                         description TEXT,
                         annex_reference VARCHAR(10),
-                        embedding vector(1536)
+                        embedding halfvec(1536)
                     );
                 """)
                 
@@ -50,141 +345,687 @@ class PostgresVectorService:
                         id SERIAL PRIMARY KEY,
                         annex_reference VARCHAR(10),
                         guidance_text TEXT,
-                        embedding vector(1536)
+                        embedding halfvec(1536)
                     );
                 """)
-                
-                # Create indexes only if we have data
+
                 cur.execute("""
-                    CREATE INDEX IF NOT EXISTS risk_embedding_idx ON risk_embeddings 
-                    USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+                    CREATE TABLE IF NOT EXISTS query_embeddings (
+                        hash CHAR(64) PRIMARY KEY,
+                        query_text TEXT,
+                        embedding halfvec(1536),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
                 """)
                 
                 cur.execute("""
-                    CREATE INDEX IF NOT EXISTS control_embedding_idx ON control_embeddings 
-                    USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+                    ALTER TABLE control_embeddings
+                    ADD COLUMN IF NOT EXISTS embedding_sq8 BYTEA,
+                    ADD COLUMN IF NOT EXISTS embedding_sq8_scale REAL;
                 """)
-                
-                self.conn.commit()
+
+                # Decided before the column migration, which drops the legacy
+                # indexes this check looks at
+                needs_normalize = self._has_unnormalized_embeddings(cur)
+
+                for table in EMBEDDING_TABLES:
+                    self._migrate_embedding_column(cur, table)
+
+                if needs_normalize:
+                    self._normalize_embeddings(cur)
+
+                # Once here rather than on the search path; every later write
+                # stores the sq8 columns itself
+                with conn:
+                    self._backfill_sq8(cur)
+
+                for table, index_name in VECTOR_INDEXES.items():
+                    self._ensure_vector_index(cur, table, index_name)
+
+                # Pattern ops let the annex prefix filter (LIKE 'A.5%') use the index
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS control_annex_reference_idx
+                    ON control_embeddings (annex_reference varchar_pattern_ops);
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS control_user_id_idx ON control_embeddings (user_id);")
+
+                if POSTGRES_PREWARM:
+                    self._prewarm_indexes(cur)
+        except Exception as e:
+            logger.error("Error creating tables: %s", e)
+            raise
+
+    def _prewarm_indexes(self, cur):
+        # Graph traversal is dominated by random page reads, so the first
+        # searches after a restart are slow until the index is cached. Loading
+        # it up front avoids that; on NVMe also set effective_io_concurrency
+        # (e.g. 200) in postgresql.conf so cold reads get OS readahead.
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm;")
+            for index_name in VECTOR_INDEXES.values():
+                cur.execute("SELECT pg_prewarm(%s::regclass)", (index_name,))
+                logger.info("Prewarmed %s (%s blocks)", index_name, cur.fetchone()[0])
+        except Exception as e:
+            logger.warning("Could not prewarm vector indexes: %s", e)
+
+    def _migrate_embedding_column(self, cur, table: str):
+        cur.execute("""
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attname = 'embedding'
+        """, (table,))
+        row = cur.fetchone()
+        if not row or row[0] == EMBEDDING_TYPE:
+            return
+
+        logger.info("Converting %s.embedding from %s to %s", table, row[0], EMBEDDING_TYPE)
+        # Indexes on the column use vector operator classes that do not apply
+        # to halfvec; drop them and let _ensure_vector_index rebuild
+        cur.execute("""
+            SELECT i.indexrelid::regclass::text
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = %s::regclass AND a.attname = 'embedding'
+        """, (table,))
+        index_names = [r[0] for r in cur.fetchall()]
+        with cur.connection:
+            for index_name in index_names:
+                cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+            cur.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE {EMBEDDING_TYPE} USING embedding::{EMBEDDING_TYPE}")
+
+    def _index_opclass(self, cur, index_name: str) -> Optional[str]:
+        cur.execute("""
+            SELECT opc.opcname FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_opclass opc ON opc.oid = i.indclass[0]
+            WHERE c.relname = %s
+        """, (index_name,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def _has_unnormalized_embeddings(self, cur) -> bool:
+        # Rows are only stored unit-length since the switch to inner-product
+        # indexes on halfvec; a legacy opclass or column type predates that
+        if any(self._index_opclass(cur, name) not in (None, EMBEDDING_OPCLASS)
+               for name in VECTOR_INDEXES.values()):
+            return True
+        cur.execute("""
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = ANY(%s::regclass[]) AND attname = 'embedding'
+        """, (list(EMBEDDING_TABLES),))
+        return any(row[0] != EMBEDDING_TYPE for row in cur.fetchall())
+
+    def _normalize_embeddings(self, cur):
+        # One-off migration from cosine indexes: existing rows were stored
+        # unnormalized, which inner-product ranking does not tolerate
+        logger.info("Normalizing stored embeddings for %s", EMBEDDING_OPCLASS)
+        with cur.connection:
+            for table in EMBEDDING_TABLES:
+                cur.execute(f"UPDATE {table} SET embedding = l2_normalize(embedding) WHERE embedding IS NOT NULL")
+
+    def _choose_hnsw_params(self, cur, table: str) -> Dict[str, int]:
+        # reltuples is the planner's row estimate: no table scan, and -1 until
+        # the table has been vacuumed or analyzed for the first time
+        cur.execute("SELECT reltuples FROM pg_class WHERE relname = %s", (table,))
+        row = cur.fetchone()
+        rows = max(row[0], 0) if row else 0
+        for limit, params in HNSW_BUCKETS:
+            if limit is None or rows < limit:
+                return params
+
+    def _choose_ivfflat_params(self, cur, table: str, index_name: str) -> Dict[str, int]:
+        cur.execute("SELECT reltuples FROM pg_class WHERE relname = %s", (table,))
+        row = cur.fetchone()
+        rows = row[0] if row else 0
+        if rows <= 0:
+            # Not analyzed yet, which is the norm right after the first load
+            cur.execute(f"SELECT count(*) FROM {table}")
+            rows = cur.fetchone()[0]
+        target = max(IVFFLAT_MIN_LISTS, round(rows ** 0.5))
+        cur.execute("SELECT reloptions FROM pg_class WHERE relname = %s", (index_name,))
+        row = cur.fetchone()
+        options = dict(option.split("=", 1) for option in (row[0] or [])) if row else {}
+        built = int(options.get("lists", 0))
+        # Keep the built list count while it is close enough to the target,
+        # so the index is only rebuilt once the table has clearly outgrown it
+        if built and target / IVFFLAT_LISTS_DRIFT <= built <= target * IVFFLAT_LISTS_DRIFT:
+            return {"lists": built}
+        return {"lists": target}
+
+    def _ensure_vector_index(self, cur, table: str, index_name: str):
+        if self.index_kind == "hnsw":
+            self._hnsw_params[table] = self._choose_hnsw_params(cur, table)
+            params = {k: self._hnsw_params[table][k] for k in ("m", "ef_construction")}
+        else:
+            params = self._choose_ivfflat_params(cur, table, index_name)
+        if self._vector_index_current(cur, index_name, params):
+            return
+
+        if self.index_kind == "ivfflat":
+            # IVFFlat clusters the rows present at build time, so an index
+            # built on an empty table is useless; wait until data is loaded
+            cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+            if not cur.fetchone()[0]:
+                return
+
+        # Every worker runs create_tables at startup; only one may build,
+        # the rest wait and then find the index already current. The lock is
+        # polled rather than waited on: a blocked pg_advisory_lock call holds
+        # a snapshot that the concurrent build itself waits out.
+        lock_key = self._index_lock_key(cur, index_name)
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (lock_key,))
+            if cur.fetchone()[0]:
+                break
+            time.sleep(1)
+        try:
+            if not self._vector_index_current(cur, index_name, params):
+                self._build_vector_index(cur, table, index_name, params)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (lock_key,))
+
+    def _index_lock_key(self, cur, index_name: str) -> int:
+        """Advisory lock key that serializes builds of `index_name` across workers."""
+        cur.execute("SELECT hashtext(%s)", (index_name,))
+        return cur.fetchone()[0]
+
+    def _vector_index_current(self, cur, index_name: str, params: Dict[str, int]) -> bool:
+        cur.execute("""
+            SELECT am.amname, c.reloptions
+            FROM pg_class c JOIN pg_am am ON am.oid = c.relam
+            WHERE c.relname = %s
+        """, (index_name,))
+        row = cur.fetchone()
+        return bool(row and row[0] == self.index_kind and self._index_opclass(cur, index_name) == EMBEDDING_OPCLASS
+                    and sorted(row[1] or []) == sorted(f"{k}={v}" for k, v in params.items()))
+
+    def _build_vector_index(self, cur, table: str, index_name: str, params: Dict[str, int]):
+        # Built concurrently under a temporary name and swapped in, so the
+        # old index keeps serving searches and writes aren't blocked during
+        # the build. A failed concurrent build leaves an invalid index behind,
+        # hence the initial drop.
+        options = ", ".join(f"{k} = {v}" for k, v in params.items())
+        building = f"{index_name}_building"
+        cur.execute(f"DROP INDEX IF EXISTS {building}")
+        cur.execute("SET maintenance_work_mem = %s", (POSTGRES_MAINTENANCE_WORK_MEM,))
+        cur.execute("SET max_parallel_maintenance_workers = %s", (HNSW_BUILD_WORKERS,))
+        try:
+            cur.execute(f"""
+                CREATE INDEX CONCURRENTLY {building} ON {table}
+                USING {self.index_kind} (embedding {EMBEDDING_OPCLASS}) WITH ({options})
+            """)
+        finally:
+            cur.execute("RESET maintenance_work_mem")
+            cur.execute("RESET max_parallel_maintenance_workers")
+        with cur.connection:
+            cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+            cur.execute(f"ALTER INDEX {building} RENAME TO {index_name}")
+
+    def maybe_reindex(self):
+        """Rebuild HNSW indexes whose table has grown into another size bucket,
+        and build or resize IVFFlat indexes as their tables fill."""
+        # Called after bulk writes, when cached selectivity estimates go stale
+        self._annex_fractions.clear()
+        if not self.pool:
+            return
+        try:
+            with self.connection() as conn, conn.cursor() as cur:
+                for table, index_name in VECTOR_INDEXES.items():
+                    if self.index_kind == "ivfflat":
+                        # Skipped at startup while the table was empty, so the
+                        # first load builds it here rather than on a restart
+                        self._ensure_vector_index(cur, table, index_name)
+                        continue
+                    current = self._hnsw_params.get(table)
+                    params = self._choose_hnsw_params(cur, table)
+                    if current is None:
+                        self._hnsw_params[table] = params
+                        continue
+                    if (params["m"], params["ef_construction"]) == (current["m"], current["ef_construction"]):
+                        continue
+
+                    # Every worker calls this after its own writes; whichever
+                    # takes the lock rebuilds and the others skip this round
+                    lock_key = self._index_lock_key(cur, index_name)
+                    cur.execute("SELECT pg_try_advisory_lock(%s)", (lock_key,))
+                    if not cur.fetchone()[0]:
+                        continue
+                    try:
+                        build_params = {k: params[k] for k in ("m", "ef_construction")}
+                        if not self._vector_index_current(cur, index_name, build_params):
+                            self._rebuild_hnsw_index(cur, index_name, build_params, current)
+                        # Recorded only once the index matches, so a failed
+                        # rebuild is retried after the next write
+                        self._hnsw_params[table] = params
+                    finally:
+                        cur.execute("SELECT pg_advisory_unlock(%s)", (lock_key,))
         except Exception as e:
-            print(f"Error creating tables: {e}")
-            self.conn.rollback()
+            logger.error("Error rebuilding vector indexes: %s", e)
+
+    def _rebuild_hnsw_index(self, cur, index_name: str, params: Dict[str, int], current: Dict[str, int]):
+        logger.info("Rebuilding %s with m=%s, ef_construction=%s", index_name, params["m"], params["ef_construction"])
+        # REINDEX CONCURRENTLY cannot run inside a transaction block, so the
+        # build settings are applied to the session and reset
+        cur.execute(f"ALTER INDEX {index_name} SET (m = %s, ef_construction = %s)",
+                    (params["m"], params["ef_construction"]))
+        cur.execute("SET maintenance_work_mem = %s", (POSTGRES_MAINTENANCE_WORK_MEM,))
+        cur.execute("SET max_parallel_maintenance_workers = %s", (HNSW_BUILD_WORKERS,))
+        try:
+            cur.execute(f"REINDEX INDEX CONCURRENTLY {index_name}")
+        except Exception:
+            # Put the options back so they keep describing the built index
+            # and the next attempt doesn't see it as current
+            cur.execute(f"ALTER INDEX {index_name} SET (m = %s, ef_construction = %s)",
+                        (current["m"], current["ef_construction"]))
             raise
+        finally:
+            cur.execute("RESET maintenance_work_mem")
+            cur.execute("RESET max_parallel_maintenance_workers")
+
+    @contextmanager
+    def _search_cursor(self, *tables: str):
+        # SET LOCAL only lasts until the end of the current transaction, so
+        # each search runs inside its own explicit transaction block
+        with self.connection() as conn, conn:
+            # RealDictRows are dicts already, so results are returned as
+            # fetched rather than copied row by row
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # A bitmap scan on a filter column returns rows unordered and
+                # forces a full re-sort, discarding the ANN index's ordered walk
+                cur.execute("SET LOCAL enable_bitmapscan = off")
+                if self.index_kind == "hnsw":
+                    ef_search = max(self._hnsw_params.get(table, HNSW_BUCKETS[0][1])["ef_search"] for table in tables)
+                    cur.execute("SET LOCAL hnsw.ef_search = %s", (ef_search,))
+                else:
+                    cur.execute("SET LOCAL ivfflat.probes = %s", (IVFFLAT_PROBES,))
+                yield cur
+
+    def _annex_fraction(self, cur, annex_filter: str) -> float:
+        """Planner estimate of the share of controls matching an annex prefix."""
+        fraction = self._annex_fractions.get(annex_filter)
+        if fraction is None:
+            cur.execute("EXPLAIN (FORMAT JSON) SELECT 1 FROM control_embeddings WHERE annex_reference LIKE %s",
+                        (f"{annex_filter}%",))
+            plan_rows = cur.fetchone()["QUERY PLAN"][0]["Plan"]["Plan Rows"]
+            cur.execute("SELECT reltuples FROM pg_class WHERE relname = 'control_embeddings'")
+            total = max(cur.fetchone()["reltuples"], 1)
+            fraction = min(plan_rows / total, 1.0)
+            self._annex_fractions[annex_filter] = fraction
+        return fraction
+
+    def _annex_filter_uses_ann(self, cur, annex_filter: str, limit: int) -> bool:
+        # The ANN index filters after ranking, so it only fills `limit` rows
+        # when enough of the candidates it visits match; otherwise scan the
+        # annex's rows exactly
+        fraction = self._annex_fraction(cur, annex_filter)
+        if self.index_kind == "hnsw":
+            ef_search = self._hnsw_params.get("control_embeddings", HNSW_BUCKETS[0][1])["ef_search"]
+            return fraction * ef_search >= 2 * limit
+        return fraction >= 0.5
+
+    @contextmanager
+    def _write_cursor(self):
+        # Embeddings can be regenerated from their source text, so losing the
+        # last few writes in a crash is acceptable: skip the WAL flush wait
+        with self.connection() as conn, conn:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL synchronous_commit = off")
+                yield cur
+
+    def _execute_prepared(self, cur, name: str, params: Tuple):
+        # Prepared statements live in the session, so track them per connection
+        prepared = self._prepared.setdefault(cur.connection, set())
+        if name not in prepared:
+            cur.execute(SEARCH_STATEMENTS[name])
+            prepared.add(name)
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name}({placeholders})", params)
 
     def store_risk_embedding(self, risk_id: str, user_id: str, description: str, 
-                           category: str, embedding: List[float]):
-        with self.conn.cursor() as cur:
+                           category: str, embedding: np.ndarray):
+        with self._write_cursor() as cur:
             cur.execute("""
                 INSERT INTO risk_embeddings (risk_id, user_id, description, category, embedding)
                 VALUES (%s, %s, %s, %s, %s)
                 ON CONFLICT (risk_id) DO UPDATE SET embedding = EXCLUDED.embedding
-            """, (risk_id, user_id, description, category, embedding))
-            self.conn.commit()
+            """, (risk_id, user_id, description, category, as_vector(embedding)))
+        self.clear_search_cache()
 
     def store_control_embedding(self, control_id: str, user_id: str, title: str,
-                              description: str, annex_reference: str, embedding: List[float]):
-        with self.conn.cursor() as cur:
+                              description: str, annex_reference: str, embedding: np.ndarray):
+        with self._write_cursor() as cur:
             cur.execute("""
-                INSERT INTO control_embeddings (control_id, user_id, title, description, annex_reference, embedding)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (control_id) DO UPDATE SET embedding = EXCLUDED.embedding
-            """, (control_id, user_id, title, description, annex_reference, embedding))
-            self.conn.commit()
-
-    def search_similar_risks(self, query_embedding: List[float], limit: int = 5) -> List[Dict]:
-        if not self.conn:
-            return []
+                INSERT INTO control_embeddings (control_id, user_id, title, description, annex_reference,
+                                                embedding, embedding_sq8, embedding_sq8_scale)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (control_id) DO UPDATE SET embedding = EXCLUDED.embedding,
+                    embedding_sq8 = EXCLUDED.embedding_sq8, embedding_sq8_scale = EXCLUDED.embedding_sq8_scale
+            """, (control_id, user_id, title, description, annex_reference, *self._control_vectors(embedding)))
+        self._sq8_loaded_at = float("-inf")
+        self._invalidate_user_matrices([user_id])
+        self.clear_search_cache()
+
+    def get_or_create_query_embedding(self, text: str, embed: Callable[[str], np.ndarray],
+                                      model: str = "") -> np.ndarray:
+        """Return the embedding for a query, calling `embed` only on a cache miss.
+
+        Queries are case- and whitespace-normalized so trivially different
+        phrasings share an entry, and keyed by `model` so switching embedding
+        models never serves stale vectors. Hits are served from a
+        process-local LRU first and the query_embeddings table second. The
+        returned array is shared, read-only and float16, matching the
+        halfvec precision it was stored at; the search methods widen it.
+        """
+        text = " ".join(text.split()).lower()
+        key = hashlib.sha256(f"{model}:{text}".encode()).hexdigest()
+        return self._cached_query_embedding(key, text, embed)
+
+    def _load_query_embedding(self, key: str, text: str, embed: Callable[[str], np.ndarray]) -> np.ndarray:
+        embedding = None
+        if self.pool:
+            try:
+                with self.connection() as conn, conn.cursor() as cur:
+                    cur.execute("SELECT embedding FROM query_embeddings WHERE hash = %s", (key,))
+                    row = cur.fetchone()
+                if row:
+                    embedding = row[0].to_numpy() if hasattr(row[0], "to_numpy") else row[0]
+            except Exception as e:
+                logger.error("Database error reading query embedding: %s", e)
+
+        if embedding is None:
+            embedding = embed(text)
+            if self.pool:
+                # The caller only needs the vector; persisting it for other
+                # workers and restarts can finish after the response
+                self._write_executor.submit(self._store_query_embedding, key, text, as_vector(embedding))
+
+        # Half precision halves the LRU's footprint (3 KB per entry) and loses
+        # nothing: the stored copy is already a halfvec
+        embedding = as_vector(embedding).astype(np.float16)
+        embedding.flags.writeable = False
+        return embedding
+
+    def _store_query_embedding(self, key: str, text: str, embedding: np.ndarray):
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Check if table exists and has data
+            with self._write_cursor() as cur:
                 cur.execute("""
-                    SELECT COUNT(*) FROM information_schema.tables 
-                    WHERE table_name = 'risk_embeddings'
-                """)
-                table_exists = cur.fetchone()[0] > 0
-                
-                if not table_exists:
-                    return []
-                
-                cur.execute("SELECT COUNT(*) FROM risk_embeddings;")
-                count = cur.fetchone()[0]
-                
-                if count == 0:
-                    return []
-                    
-                cur.execute("""
-                    SELECT risk_id, user_id, description, category,
-                           1 - (embedding <=> %s::vector) as similarity
-                    FROM risk_embeddings
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT %s
-                """, (query_embedding, query_embedding, limit))
-                return [dict(row) for row in cur.fetchall()]
+                    INSERT INTO query_embeddings (hash, query_text, embedding)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (hash) DO NOTHING
+                """, (key, text, embedding))
+        except Exception as e:
+            logger.error("Database error storing query embedding: %s", e)
+
+    def store_control_embeddings_bulk(self, rows: List[Tuple]):
+        """Upsert (control_id, user_id, title, description, annex_reference, embedding) rows."""
+        # A single INSERT cannot update the same row twice, so keep the last
+        # occurrence of each control_id
+        rows = list({row[0]: (*row[:5], *self._control_vectors(row[5])) for row in rows}.values())
+        if not rows:
+            return
+        with self._write_cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO control_embeddings (control_id, user_id, title, description, annex_reference,
+                                                embedding, embedding_sq8, embedding_sq8_scale)
+                VALUES %s
+                ON CONFLICT (control_id) DO UPDATE SET embedding = EXCLUDED.embedding,
+                    embedding_sq8 = EXCLUDED.embedding_sq8, embedding_sq8_scale = EXCLUDED.embedding_sq8_scale
+            """, rows, template="(%s, %s, %s, %s, %s, %s, %s, %s)", page_size=500)
+        self._sq8_loaded_at = float("-inf")
+        self._invalidate_user_matrices({row[1] for row in rows})
+        self.clear_search_cache()
+
+    def clear_search_cache(self):
+        with self._search_cache_lock:
+            self._search_cache.clear()
+            self._search_cache_generation += 1
+
+    def get_search_cache_stats(self) -> Dict[str, int]:
+        with self._search_cache_lock:
+            return {
+                "hits": self._search_cache_hits,
+                "misses": self._search_cache_misses,
+                "size": len(self._search_cache),
+            }
+
+    @staticmethod
+    def _control_vectors(embedding) -> Tuple:
+        embedding = as_vector(embedding)
+        q, scale = quantize_sq8(embedding)
+        return embedding, q.tobytes(), scale
+
+    def _scan(self, conn, name: str, query: str):
+        """Stream a large result set through a server-side cursor. Must be
+        called inside a transaction on `conn`."""
+        with conn.cursor(name=name) as scan:
+            scan.itersize = SCAN_ITERSIZE
+            scan.execute(query)
+            yield from scan
+
+    def _backfill_sq8(self, cur):
+        # Rows written before the sq8 columns existed, or by kg_setup_script
+        updates = []
+        for row_id, embedding in self._scan(cur.connection, "control_sq8_backfill", """
+            SELECT id, embedding FROM control_embeddings
+            WHERE embedding_sq8 IS NULL AND embedding IS NOT NULL
+        """):
+            q, scale = quantize_sq8(embedding.to_numpy() if hasattr(embedding, "to_numpy") else embedding)
+            updates.append((row_id, q.tobytes(), scale))
+        if updates:
+            execute_values(cur, """
+                UPDATE control_embeddings c
+                SET embedding_sq8 = v.sq8, embedding_sq8_scale = v.scale
+                FROM (VALUES %s) AS v (id, sq8, scale)
+                WHERE c.id = v.id
+            """, updates, template="(%s, %s::bytea, %s::real)", page_size=500)
+
+    def _control_sq8_snapshot(self) -> Optional[Dict]:
+        """Quantized control vectors for the linear-scan lane, or None when
+        the table is too large for it and the ANN index should be used."""
+        with self._sq8_lock:
+            if time.monotonic() - self._sq8_loaded_at < SQ8_CACHE_TTL:
+                return self._sq8_snapshot
+            # Claim the reload: other searches see a fresh timestamp and keep
+            # using the current snapshot until the new one is swapped in
+            started = self._sq8_loaded_at = time.monotonic()
+
+        try:
+            snapshot = self._load_control_sq8_snapshot()
+        except Exception:
+            with self._sq8_lock:
+                if self._sq8_loaded_at == started:
+                    self._sq8_loaded_at = float("-inf")
+            raise
+        # A write during the load has already reset the timestamp, so the
+        # next search reloads again
+        with self._sq8_lock:
+            self._sq8_snapshot = snapshot
+        return snapshot
+
+    def _load_control_sq8_snapshot(self) -> Optional[Dict]:
+        snapshot = None
+        with self.connection() as conn, conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT count(*) FROM (SELECT 1 FROM control_embeddings LIMIT %s) t",
+                            (POSTGRES_BRUTE_FORCE_MAX_ROWS + 1,))
+                if cur.fetchone()[0] <= POSTGRES_BRUTE_FORCE_MAX_ROWS:
+                    control_ids, user_ids, annex, vectors, scales = [], [], [], bytearray(), []
+                    for control_id, user_id, annex_reference, sq8, scale in self._scan(conn, "control_sq8_scan", """
+                        SELECT control_id, user_id, annex_reference, embedding_sq8, embedding_sq8_scale
+                        FROM control_embeddings
+                        WHERE embedding_sq8 IS NOT NULL
+                    """):
+                        control_ids.append(control_id)
+                        user_ids.append(user_id or "")
+                        annex.append(annex_reference or "")
+                        vectors += sq8
+                        scales.append(scale)
+                    snapshot = {
+                        "control_ids": control_ids,
+                        "user_ids": np.array(user_ids, dtype=str),
+                        "annex": np.array(annex, dtype=str),
+                        "vectors": np.frombuffer(bytes(vectors), dtype=np.int8).reshape(len(control_ids), 1536),
+                        "scales": np.array(scales, dtype=np.float32),
+                    }
+        return snapshot
+
+    def _search_controls_sq8(self, snapshot: Dict, query_embedding: np.ndarray,
+                             annex_filter: Optional[str], limit: int, user_id: Optional[str] = None) -> List[Dict]:
+        q, q_scale = quantize_sq8(query_embedding)
+        # int32 accumulation keeps the int8 dot products exact
+        scores = np.einsum("ij,j->i", snapshot["vectors"], q, dtype=np.int32) * snapshot["scales"] * q_scale
+        if annex_filter:
+            scores = np.where(np.char.startswith(snapshot["annex"], annex_filter), scores, -np.inf)
+        if user_id:
+            scores = np.where(snapshot["user_ids"] == user_id, scores, -np.inf)
+
+        return self._top_controls(snapshot["control_ids"], scores, limit)
+
+    def _top_controls(self, control_ids: List[str], scores: np.ndarray, limit: int) -> List[Dict]:
+        """Fetch the `limit` best-scoring controls; -inf scores are filtered out."""
+        k = min(limit, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = [i for i in top[np.argsort(-scores[top])] if np.isfinite(scores[i])]
+        if not top:
+            return []
+
+        ids = [control_ids[i] for i in top]
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            self._execute_prepared(cur, "fetch_controls", (ids,))
+            rows = {row["control_id"]: row for row in cur.fetchall()}
+        results = []
+        for i in top:
+            row = rows.get(control_ids[i])
+            if row is not None:
+                row["similarity"] = float(scores[i])
+                results.append(row)
+        return results
+
+    def _invalidate_user_matrices(self, user_ids):
+        with self._user_matrices_lock:
+            for user_id in user_ids:
+                self._user_matrices.pop(user_id, None)
+
+    def load_user_control_matrix(self, user_id: str) -> Dict:
+        """A user's control ids, annex references and unit-length float16 embeddings (N, 1536)."""
+        now = time.monotonic()
+        with self._user_matrices_lock:
+            cached = self._user_matrices.get(user_id)
+            if cached and now - cached[0] < SQ8_CACHE_TTL:
+                self._user_matrices.move_to_end(user_id)
+                return cached[1]
+
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT control_id, annex_reference, embedding FROM control_embeddings
+                WHERE user_id = %s AND embedding IS NOT NULL
+            """, (user_id,))
+            rows = cur.fetchall()
+        matrix = {
+            "control_ids": [r[0] for r in rows],
+            "annex": np.array([r[1] or "" for r in rows], dtype=str),
+            "vectors": np.array([r[2].to_numpy() if hasattr(r[2], "to_numpy") else r[2] for r in rows],
+                                dtype=np.float16).reshape(len(rows), 1536),
+        }
+        with self._user_matrices_lock:
+            self._user_matrices[user_id] = (now, matrix)
+            self._user_matrices.move_to_end(user_id)
+            while len(self._user_matrices) > USER_MATRIX_CACHE_SIZE:
+                self._user_matrices.popitem(last=False)
+        return matrix
+
+    def _search_user_controls(self, user_id: str, query_embedding: np.ndarray,
+                              annex_filter: Optional[str], limit: int) -> List[Dict]:
+        matrix = self.load_user_control_matrix(user_id)
+        # Rows are stored unit-length, so the product is cosine similarity
+        scores = matrix["vectors"].astype(np.float32) @ query_embedding
+        if annex_filter:
+            scores = np.where(np.char.startswith(matrix["annex"], annex_filter), scores, -np.inf)
+        return self._top_controls(matrix["control_ids"], scores, limit)
+
+    @cached_search
+    def search_similar_risks(self, query_embedding: np.ndarray, limit: int = 5) -> List[Dict]:
+        if not self.pool:
+            return []
+        query_embedding = as_vector(query_embedding)
+        try:
+            with self._search_cursor("risk_embeddings") as cur:
+                self._execute_prepared(cur, "search_risks", (query_embedding, limit))
+                return cur.fetchall()
         except Exception as e:
-            # Suppress "0" errors which are normal empty database responses
-            if str(e).strip() not in ["0", ""]:
-                print(f"Database error searching similar risks: {e}")
+            logger.error("Database error searching similar risks: %s", e)
             return []
 
-    def search_similar_controls(self, query_embedding: List[float], 
-                              annex_filter: str = None, limit: int = 10) -> List[Dict]:
-        if not self.conn:
+    @cached_search
+    def search_similar_controls(self, query_embedding: np.ndarray, 
+                              annex_filter: str = None, limit: int = 10,
+                              user_id: Optional[str] = None) -> List[Dict]:
+        if not self.pool:
             return []
+        query_embedding = as_vector(query_embedding)
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Check if table has any data first
-                cur.execute("SELECT COUNT(*) FROM control_embeddings;")
-                count = cur.fetchone()[0]
-                
-                if count == 0:
-                    return []
-                    
-                query = """
-                    SELECT control_id, user_id, title, description, annex_reference,
-                           1 - (embedding <=> %s::vector) as similarity
-                    FROM control_embeddings
-                """
-                params = [query_embedding, query_embedding]
-                
+            snapshot = self._control_sq8_snapshot()
+            if snapshot is not None:
+                return self._search_controls_sq8(snapshot, query_embedding, annex_filter, limit, user_id)
+            if user_id:
+                return self._search_user_controls(user_id, query_embedding, annex_filter, limit)
+            with self._search_cursor("control_embeddings") as cur:
                 if annex_filter:
-                    query += " WHERE annex_reference LIKE %s"
-                    params.append(f"{annex_filter}%")
-                
-                query += " ORDER BY embedding <=> %s::vector LIMIT %s"
-                params.append(limit)
-                
-                cur.execute(query, params)
-                return [dict(row) for row in cur.fetchall()]
+                    name = ("search_controls_by_annex_ann" if self._annex_filter_uses_ann(cur, annex_filter, limit)
+                            else "search_controls_by_annex")
+                    self._execute_prepared(cur, name, (f"{annex_filter}%", query_embedding, limit))
+                else:
+                    self._execute_prepared(cur, "search_controls", (query_embedding, limit))
+                return cur.fetchall()
         except Exception as e:
-            # Suppress "0" errors which are normal empty database responses
-            if str(e).strip() not in ["0", ""]:
-                print(f"Database error searching similar controls: {e}")
+            logger.error("Database error searching similar controls: %s", e)
             return []
 
-    def get_iso_guidance(self, query_embedding: List[float], limit: int = 3) -> List[Dict]:
-        if not self.conn:
+    @cached_search
+    def get_iso_guidance(self, query_embedding: np.ndarray, limit: int = 3) -> List[Dict]:
+        if not self.pool:
             return []
+        query_embedding = as_vector(query_embedding)
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Check if table has any data first
-                cur.execute("SELECT COUNT(*) FROM iso_guidance_embeddings;")
-                count = cur.fetchone()[0]
-                
-                if count == 0:
-                    return []
-                    
-                cur.execute("""
-                    SELECT annex_reference, guidance_text,
-                           1 - (embedding <=> %s::vector) as similarity
-                    FROM iso_guidance_embeddings
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT %s
-                """, (query_embedding, query_embedding, limit))
-                return [dict(row) for row in cur.fetchall()]
+            with self._search_cursor("iso_guidance_embeddings") as cur:
+                self._execute_prepared(cur, "search_iso_guidance", (query_embedding, limit))
+                return cur.fetchall()
         except Exception as e:
-            # Suppress "0" errors which are normal empty database responses
-            if str(e).strip() not in ["0", ""]:
-                print(f"Database error getting ISO guidance: {e}")
+            logger.error("Database error getting ISO guidance: %s", e)
             return []
 
+    @cached_search
+    def search_all(self, query_embedding: np.ndarray, user_id: str, control_limit: int = 5,
+                   risk_limit: int = 3, guidance_limit: int = 3) -> Dict[str, List[Dict]]:
+        """Run the user's control search plus the risk and ISO guidance searches in a single query."""
+        results = {"similar_controls": [], "similar_risks": [], "iso_guidance": []}
+        if not self.pool:
+            return results
+        query_embedding = as_vector(query_embedding)
+        try:
+            with self._search_cursor("control_embeddings", "risk_embeddings", "iso_guidance_embeddings") as cur:
+                self._execute_prepared(cur, "search_all",
+                                       (query_embedding, control_limit, risk_limit, guidance_limit, user_id))
+                for row in cur.fetchall():
+                    if row["tag"] == "control":
+                        results["similar_controls"].append({
+                            "control_id": row["item_id"], "user_id": row["user_id"], "title": row["title"],
+                            "description": row["description"], "annex_reference": row["annex_reference"],
+                            "similarity": row["similarity"],
+                        })
+                    elif row["tag"] == "risk":
+                        results["similar_risks"].append({
+                            "risk_id": row["item_id"], "user_id": row["user_id"], "description": row["description"],
+                            "category": row["category"], "similarity": row["similarity"],
+                        })
+                    else:
+                        results["iso_guidance"].append({
+                            "annex_reference": row["annex_reference"], "guidance_text": row["guidance_text"],
+                            "similarity": row["similarity"],
+                        })
+        except Exception as e:
+            logger.error("Database error running combined vector search: %s", e)
+        return results
+
 postgres_service = PostgresVectorService()
\ No newline at end of file
@@ -1,26 +1,58 @@
-from typing import Dict, List
-from .openai_service import openai_service
-from .postgres import postgres_service
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+import json
+import threading
+import time
+import numpy as np
+from .openai_service import openai_service, EMBEDDING_MODEL
+from .postgres import postgres_service, copy_rows
 from .neo4j_db import neo4j_service
 from .database import mongodb
 
+# Query contexts are reused for this long unless the user's data changes first.
+# Risks are also written outside this app, which only the TTL catches.
+CONTEXT_CACHE_TTL = 300
+CONTEXT_CACHE_MAX_ENTRIES = 1000
+
 class RAGService:
     def __init__(self):
         self.openai = openai_service
         self.vector_db = postgres_service
         self.graph_db = neo4j_service
         self.mongo_db = mongodb
+        # The vector lookups are independent round trips on pooled
+        # connections, so they run side by side
+        self.search_executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix="vector-search")
+        self.embedding_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="embeddings")
+        self._backfilled_users = set()
+        self._context_cache: Dict[Tuple, Tuple[float, Dict]] = {}
+        self._context_cache_lock = threading.Lock()
+
+    def close(self):
+        self.search_executor.shutdown(wait=True)
+        # Jobs still queued stay in pending_embeddings and are replayed on
+        # the next startup, so only the running ones are waited for
+        self.embedding_executor.shutdown(wait=True, cancel_futures=True)
 
     def retrieve_context_for_control_generation(self, risk_data: Dict, user_context: Dict) -> Dict:
         risk_description = risk_data.get('description', '')
         risk_category = risk_data.get('category', '')
         user_domain = user_context.get('domain', '')
+
+        # The graph lookups do not depend on the embedding, so they run while
+        # it is fetched and the vector searches run
+        controls_future = self.search_executor.submit(
+            self.graph_db.get_similar_controls_by_domain, user_domain, risk_category)
+        patterns_future = self.search_executor.submit(self._get_risk_patterns, risk_category, user_domain)
         
         # Try to get embeddings, but fallback gracefully if DB issues
         try:
-            query_embedding = self.openai.get_embedding(risk_description)
-            similar_risks = self.vector_db.search_similar_risks(query_embedding, limit=3)
-            iso_guidance = self.vector_db.get_iso_guidance(query_embedding, limit=2)
+            query_embedding = self.get_query_embedding(risk_description)
+            risks_future = self.search_executor.submit(self.vector_db.search_similar_risks, query_embedding, limit=3)
+            guidance_future = self.search_executor.submit(self.vector_db.get_iso_guidance, query_embedding, limit=2)
+            similar_risks = risks_future.result()
+            iso_guidance = guidance_future.result()
         except Exception as e:
             print(f"Vector search failed, proceeding without: {e}")
             similar_risks = []
@@ -28,7 +60,7 @@ class RAGService:
         
         # Try graph operations
         try:
-            similar_controls = self.graph_db.get_similar_controls_by_domain(user_domain, risk_category)
+            similar_controls = controls_future.result()
         except Exception as e:
             print(f"Graph search failed, proceeding without: {e}")
             similar_controls = []
@@ -37,12 +69,45 @@ class RAGService:
             "similar_risks": similar_risks,
             "similar_controls": similar_controls,
             "iso_guidance": iso_guidance,
-            "risk_patterns": self._get_risk_patterns(risk_category, user_domain)
+            "risk_patterns": patterns_future.result()
         }
 
+    def get_query_embedding(self, text: str):
+        return self.vector_db.get_or_create_query_embedding(text, self.openai.embedding_batcher.embed, EMBEDDING_MODEL)
+
     def retrieve_context_for_query(self, query: str, intent: str, parameters: Dict, user_id: str) -> Dict:
-        query_embedding = self.openai.get_embedding(query)
-        
+        # Only query_controls is cached: it is the one intent that embeds the
+        # query and fans out to pgvector and Neo4j, and the only one callers
+        # route through here (the agent builds listing contexts itself)
+        if intent != "query_controls":
+            return self._retrieve_context_for_query(query, intent, parameters, user_id)
+        key = (
+            user_id,
+            json.dumps(parameters or {}, sort_keys=True, default=str),
+            " ".join(query.split()).lower(),
+        )
+        now = time.monotonic()
+        with self._context_cache_lock:
+            hit = self._context_cache.get(key)
+        # Copied both ways so callers can't alter what later hits return
+        if hit and now - hit[0] < CONTEXT_CACHE_TTL:
+            return copy_rows(hit[1])
+
+        context = self._retrieve_context_for_query(query, intent, parameters, user_id)
+        with self._context_cache_lock:
+            if len(self._context_cache) >= CONTEXT_CACHE_MAX_ENTRIES:
+                self._context_cache = {k: v for k, v in self._context_cache.items() if now - v[0] < CONTEXT_CACHE_TTL}
+            self._context_cache[key] = (now, copy_rows(context))
+        return context
+
+    def invalidate_user_context(self, user_id: str):
+        """Drop cached query contexts after the user's risks or controls change."""
+        with self._context_cache_lock:
+            self._context_cache = {k: v for k, v in self._context_cache.items() if k[0] != user_id}
+
+    def _retrieve_context_for_query(self, query: str, intent: str, parameters: Dict, user_id: str) -> Dict:
+        # Only query_controls searches by vector; the listing intents are
+        # answered from Mongo and Neo4j and need no embedding
         if intent == "show_finalized_controls":
             return self._get_finalized_controls_context(parameters, user_id)
         elif intent == "show_controls_by_category":
@@ -66,14 +131,13 @@ class RAGService:
             risks = [r for r in all_risks if not impact or str(r.get("impact", "")).lower() == str(impact).lower()]
             return {"risks": risks, "impact": impact, "total": len(risks)}
         elif intent == "query_controls":
-            return self._get_general_query_context(query_embedding, user_id)
+            return self._get_general_query_context(self.get_query_embedding(query), user_id)
         else:
             return {}
 
     def _get_finalized_controls_context(self, parameters: Dict, user_id: str) -> Dict:
         if parameters.get('risk_id'):
-            controls = self.mongo_db.get_controls_by_risk(parameters['risk_id'], user_id)
-            risk = self.mongo_db.get_risk_by_id(parameters['risk_id'], user_id)
+            risk, controls = self.mongo_db.get_risk_with_controls(parameters['risk_id'], user_id)
             return {"controls": controls, "risk": risk}
         else:
             user_stats = self.graph_db.get_user_risk_control_stats(user_id)
@@ -87,11 +151,20 @@ class RAGService:
         controls = self.mongo_db.get_controls_by_annex(annex, user_id)
         return {"controls": controls, "annex": annex}
 
-    def _get_general_query_context(self, query_embedding: List[float], user_id: str) -> Dict:
+    def _get_general_query_context(self, query_embedding: np.ndarray, user_id: str) -> Dict:
+        self.backfill_control_embeddings(user_id)
+        if self.vector_db.pool and self.vector_db.pool.maxconn == 1:
+            # A single connection would serialize the concurrent lookups
+            # anyway; one combined query saves the extra round trips
+            return self.vector_db.search_all(query_embedding, user_id, control_limit=5, risk_limit=3, guidance_limit=3)
         try:
-            similar_controls = self.vector_db.search_similar_controls(query_embedding, limit=5)
-            similar_risks = self.vector_db.search_similar_risks(query_embedding, limit=3)
-            iso_guidance = self.vector_db.get_iso_guidance(query_embedding, limit=3)
+            controls_future = self.search_executor.submit(self.vector_db.search_similar_controls, query_embedding,
+                                                          limit=5, user_id=user_id)
+            risks_future = self.search_executor.submit(self.vector_db.search_similar_risks, query_embedding, limit=3)
+            guidance_future = self.search_executor.submit(self.vector_db.get_iso_guidance, query_embedding, limit=3)
+            similar_controls = controls_future.result()
+            similar_risks = risks_future.result()
+            iso_guidance = guidance_future.result()
         except Exception as e:
             print(f"Vector search failed in general query: {e}")
             similar_controls = []
@@ -108,11 +181,59 @@ class RAGService:
         return self.graph_db.get_controls_by_annex_and_category("A.", risk_category)
 
     def store_control_embeddings(self, controls: List[Dict]):
-        for control in controls:
-            embedding_text = f"{control['title']} {control['description']}"
-            embedding = self.openai.get_embedding(embedding_text)
-            
-            self.vector_db.store_control_embedding(
+        """Queue controls for embedding and return without waiting on OpenAI or Postgres."""
+        if not controls:
+            return
+        # Record the batch before handing it off so a crash mid-way leaves
+        # it in pending_embeddings for replay_pending_embeddings
+        try:
+            job_id = self.mongo_db.pending_embeddings.insert_one({
+                "controls": controls,
+                "created_at": datetime.now(timezone.utc)
+            }).inserted_id
+        except Exception as e:
+            print(f"Could not record pending embeddings: {e}")
+            job_id = None
+        self.embedding_executor.submit(self._run_embedding_job, job_id, controls)
+
+    def replay_pending_embeddings(self):
+        for job in self.mongo_db.pending_embeddings.find():
+            self.embedding_executor.submit(self._run_embedding_job, job["_id"], job["controls"])
+
+    def backfill_control_embeddings(self, user_id: str):
+        """Queue embeddings for any of the user's saved controls that have none yet (once per process)."""
+        if user_id in self._backfilled_users:
+            return
+        self._backfilled_users.add(user_id)
+        try:
+            missing = list(self.mongo_db.controls.find(
+                {"user_id": user_id, "embedding_stored": {"$ne": True}, "id": {"$exists": True}},
+                {"_id": 0, "id": 1, "user_id": 1, "title": 1, "description": 1, "annex_reference": 1}
+            ))
+            if missing:
+                self.store_control_embeddings(missing)
+        except Exception as e:
+            print(f"Could not backfill control embeddings: {e}")
+
+    def _run_embedding_job(self, job_id, controls: List[Dict]):
+        try:
+            self._store_control_embeddings(controls)
+            for user_id in {control.get("user_id") for control in controls}:
+                self.invalidate_user_context(user_id)
+            self.mongo_db.controls.update_many(
+                {"id": {"$in": [control["id"] for control in controls]}},
+                {"$set": {"embedding_stored": True}}
+            )
+            if job_id is not None:
+                self.mongo_db.pending_embeddings.delete_one({"_id": job_id})
+        except Exception as e:
+            print(f"Storing control embeddings failed, left for replay: {e}")
+
+    def _store_control_embeddings(self, controls: List[Dict]):
+        texts = [f"{control['title']} {control['description']}" for control in controls]
+        embeddings = self.openai.get_embeddings_batch(texts)
+        rows = [
+            (
                 control['id'],
                 control['user_id'],
                 control['title'],
@@ -120,6 +241,11 @@ class RAGService:
                 control['annex_reference'],
                 embedding
             )
+            for control, embedding in zip(controls, embeddings)
+        ]
+
+        self.vector_db.store_control_embeddings_bulk(rows)
+        self.vector_db.maybe_reindex()
 
     def store_risk_embedding(self, risk_data: Dict):
         embedding_text = f"{risk_data.get('description', '')} {risk_data.get('category', '')}"
@@ -132,5 +258,6 @@ class RAGService:
             risk_data.get("category", ""),
             embedding
         )
+        self.invalidate_user_context(risk_data.get("user_id", ""))
 
 rag_service = RAGService()
\ No newline at end of file
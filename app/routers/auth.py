@@ -1,9 +1,12 @@
+import hmac
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter, HTTPException, Depends, Form
 from fastapi.security import OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from jose import jwt
+from pymongo.errors import DuplicateKeyError
 from pydantic import BaseModel
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Union
 from ..config import SECRET_KEY
 from ..database import mongodb
@@ -13,6 +16,7 @@ from ..auth import get_current_user
 router = APIRouter()
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+graph_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="signup-graph")
 
 class UserCreate(BaseModel):
     username: str
@@ -27,22 +31,39 @@ class Token(BaseModel):
     token_type: str
 
 def get_password_hash(password):
-    return password
+    return pwd_context.hash(password)
 
 def verify_password(plain_password, hashed_password):
-    return plain_password == hashed_password
+    if pwd_context.identify(hashed_password) is None:
+        # Accounts created before passwords were hashed store them as-is
+        return hmac.compare_digest(plain_password.encode(), hashed_password.encode())
+    return pwd_context.verify(plain_password, hashed_password)
+
+def authenticate_user(username: str, password: str):
+    user = mongodb.users.find_one({"username": username})
+    if not user or not verify_password(password, user["hashed_password"]):
+        return None
+    if pwd_context.identify(user["hashed_password"]) is None:
+        mongodb.users.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"hashed_password": get_password_hash(password)}}
+        )
+    return user
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=60))
+    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=60))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm="HS256")
 
+def create_user_node(user_data: dict):
+    try:
+        neo4j_service.create_user_node(user_data)
+    except Exception as e:
+        print(f"Warning: Failed to create user in Neo4j: {e}")
+
 @router.post("/signup", response_model=Token)
 def signup(user: UserCreate):
-    if mongodb.users.find_one({"username": user.username}):
-        raise HTTPException(status_code=400, detail="Username already registered")
-    
     hashed_password = get_password_hash(user.password)
     user_data = {
         "username": user.username,
@@ -51,21 +72,25 @@ def signup(user: UserCreate):
         "location": user.location,
         "domain": user.domain,
         "risks_applicable": user.risks_applicable,
-        "created_at": datetime.utcnow()
+        "created_at": datetime.now(timezone.utc)
     }
     
-    mongodb.users.insert_one(user_data)
-    
+    # The unique username index makes the insert itself the existence check;
+    # if it could not be built, look the username up first instead
+    if not mongodb.unique_usernames and mongodb.users.find_one({"username": user.username}, {"_id": 1}):
+        raise HTTPException(status_code=400, detail="Username already registered")
     try:
-        neo4j_service.create_user_node({
-            "user_id": user.username,
-            "username": user.username,
-            "organization_name": user.organization_name,
-            "location": user.location,
-            "domain": user.domain
-        })
-    except Exception as e:
-        print(f"Warning: Failed to create user in Neo4j: {e}")
+        mongodb.users.insert_one(user_data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username already registered")
+    
+    graph_executor.submit(create_user_node, {
+        "user_id": user.username,
+        "username": user.username,
+        "organization_name": user.organization_name,
+        "location": user.location,
+        "domain": user.domain
+    })
     
     access_token = create_access_token({"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
@@ -76,9 +101,9 @@ class LoginRequest(BaseModel):
 
 @router.post("/login", response_model=Token)
 def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = mongodb.users.find_one({"username": form_data.username})
+    user = authenticate_user(form_data.username, form_data.password)
 
-    if not user or not verify_password(form_data.password, user["hashed_password"]):
+    if not user:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
 
     access_token = create_access_token({"sub": form_data.username})
@@ -86,9 +111,9 @@ def login(form_data: OAuth2PasswordRequestForm = Depends()):
 
 @router.post("/login-json", response_model=Token)
 def login_json(login_req: LoginRequest):
-    user = mongodb.users.find_one({"username": login_req.username})
+    user = authenticate_user(login_req.username, login_req.password)
 
-    if not user or not verify_password(login_req.password, user["hashed_password"]):
+    if not user:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
 
     access_token = create_access_token({"sub": login_req.username})
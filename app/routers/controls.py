@@ -1,10 +1,17 @@
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from bson import ObjectId
+from datetime import datetime, timezone
+from pymongo.errors import BulkWriteError
+import json
+import orjson
 from ..auth import get_current_user
 from ..models import AgentResponse, ControlSelection
 from ..langgraph_agent import iso_agent
-from ..database import mongodb
+from ..database import mongodb, convert_objectid, failed_write_indexes
+from ..rag_service import rag_service
 
 router = APIRouter()
 
@@ -13,64 +20,123 @@ class ChatRequest(BaseModel):
 
 @router.post("/chat", response_model=AgentResponse)
 async def chat_with_agent(request: ChatRequest, user = Depends(get_current_user)):
-    try:
-        result = await iso_agent.run(request.query, user["username"])
+    result = await iso_agent.run(request.query, user["username"])
         
-        return AgentResponse(
-            response=result["final_response"],
-            controls=result.get("generated_controls", []),
-            pending_selection=result.get("pending_selection", False),
-            session_id=result.get("session_id", "")
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return AgentResponse(
+        response=result["final_response"],
+        controls=result.get("generated_controls", []),
+        pending_selection=result.get("pending_selection", False),
+        session_id=result.get("session_id", "")
+    )
+
+# Roughly 50 tokens; smaller deltas are buffered so each SSE frame carries
+# a useful amount of text
+STREAM_CHUNK_CHARS = 200
+
+async def sse_frames(events: AsyncIterator[Dict]) -> AsyncIterator[str]:
+    buffer = ""
+    async for event in events:
+        if event["type"] == "token":
+            buffer += event["content"]
+            if len(buffer) >= STREAM_CHUNK_CHARS:
+                yield f"data: {json.dumps({'content': buffer})}\n\n"
+                buffer = ""
+        else:
+            if buffer:
+                yield f"data: {json.dumps({'content': buffer})}\n\n"
+                buffer = ""
+            payload = {k: v for k, v in event.items() if k != "type"}
+            yield f"event: done\ndata: {json.dumps(payload, default=str)}\n\n"
+
+@router.post("/chat/stream")
+async def stream_chat_with_agent(request: ChatRequest, user = Depends(get_current_user)):
+    return StreamingResponse(
+        sse_frames(iso_agent.stream(request.query, user["username"])),
+        media_type="text/event-stream"
+    )
 
 @router.post("/select-controls")
 async def select_controls(selection: ControlSelection, user = Depends(get_current_user)):
-    try:
-        result = await iso_agent.run(
-            "", 
-            user["username"], 
-            selected_controls=selection.selected_control_ids,
-            session_id=selection.session_id
-        )
+    result = await iso_agent.run(
+        "", 
+        user["username"], 
+        selected_controls=selection.selected_control_ids,
+        session_id=selection.session_id
+    )
         
-        return AgentResponse(
-            response=result["final_response"],
-            pending_selection=False
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return AgentResponse(
+        response=result["final_response"],
+        pending_selection=False
+    )
+
+# The list view renders the control text but none of the bookkeeping fields;
+# the full document is available from the detail endpoint
+USER_CONTROLS_PROJECTION = {"embedding": 0, "embedding_stored": 0, "user_id": 0}
+
+async def stream_controls(first: Optional[Dict], cursor) -> AsyncIterator[bytes]:
+    yield b'{"controls":['
+    if first is not None:
+        # default=str covers ObjectId _ids; orjson handles datetimes itself
+        yield orjson.dumps(first, default=str)
+        async for control in cursor:
+            yield b"," + orjson.dumps(control, default=str)
+    yield b"]}"
 
 @router.get("/user-controls")
 async def get_user_controls(user = Depends(get_current_user)):
-    try:
-        controls = list(mongodb.controls.find({"user_id": user["username"]}))
-        for control in controls:
-            if "_id" in control:
-                control["_id"] = str(control["_id"])
-        return {"controls": controls}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Streamed a cursor batch at a time instead of materializing every
+    # control; the first document is read up front so query errors still
+    # surface as a 500 before the response starts
+    cursor = mongodb.controls_async.find(
+        {"user_id": user["username"]}, USER_CONTROLS_PROJECTION
+    ).batch_size(100)
+    first = await anext(cursor, None)
+    return StreamingResponse(stream_controls(first, cursor), media_type="application/json")
+
+@router.get("/user-controls/{control_id}/detail")
+async def get_user_control_detail(control_id: str, user = Depends(get_current_user)):
+    # Agent-saved controls use uuid string ids, /store-controls ones ObjectIds
+    ids = [control_id, ObjectId(control_id)] if ObjectId.is_valid(control_id) else [control_id]
+    control = await mongodb.controls_async.find_one({"_id": {"$in": ids}, "user_id": user["username"]})
+    if control is None:
+        raise HTTPException(status_code=404, detail="Control not found")
+    return {"control": convert_objectid(control)}
 
 @router.get("/controls-by-risk/{risk_id}")
-async def get_controls_by_risk(risk_id: str, user = Depends(get_current_user)):
-    try:
-        controls = mongodb.get_controls_by_risk(risk_id, user["username"])
-        return {"controls": controls}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+def get_controls_by_risk(risk_id: str, user = Depends(get_current_user)):
+    controls = mongodb.get_controls_by_risk(risk_id, user["username"])
+    return {"controls": controls}
     
 
 @router.post("/store-controls")
 async def store_controls(controls: List[Dict], user = Depends(get_current_user)):
-    try:
-        for control in controls:
-            control["user_id"] = user["username"]
-            mongodb.controls.insert_one(control)
-        return AgentResponse(
-            response="Controls stored successfully",
-            pending_selection=False
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+    now = datetime.now(timezone.utc)
+    for control in controls:
+        control["user_id"] = user["username"]
+        control.setdefault("created_at", now)
+    rejected, failed = set(), set()
+    if controls:
+        try:
+            await mongodb.controls_async.insert_many(controls, ordered=False)
+        except BulkWriteError as e:
+            # The controls validator rejects incomplete documents; the
+            # rest of the batch is still inserted
+            rejected, failed = failed_write_indexes(e)
+            if failed:
+                errmsg = next(err.get("errmsg") for err in e.details["writeErrors"] if err["index"] in failed)
+                print(f"Failed to store {len(failed)} controls: {errmsg}")
+    mongodb.invalidate_risk_ids_with_controls(user["username"])
+    rag_service.invalidate_user_context(user["username"])
+    if rejected or failed:
+        problems = []
+        if rejected:
+            problems.append(f"{len(rejected)} were rejected as incomplete")
+        if failed:
+            problems.append(f"{len(failed)} could not be saved")
+        response = f"Stored {len(controls) - len(rejected) - len(failed)} controls; {' and '.join(problems)}"
+    else:
+        response = "Controls stored successfully"
+    return AgentResponse(
+        response=response,
+        pending_selection=False
+    )
\ No newline at end of file
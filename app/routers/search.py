@@ -1,8 +1,7 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends
 from pydantic import BaseModel
 from ..auth import get_current_user
 from ..rag_service import rag_service
-from ..openai_service import openai_service
 
 router = APIRouter()
 
@@ -12,39 +11,28 @@ class SearchRequest(BaseModel):
     limit: int = 10
 
 @router.post("/similar-risks")
-async def search_similar_risks(request: SearchRequest, user = Depends(get_current_user)):
-    try:
-        query_embedding = openai_service.get_embedding(request.query)
-        results = rag_service.vector_db.search_similar_risks(query_embedding, request.limit)
-        return {"results": results}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+def search_similar_risks(request: SearchRequest, user = Depends(get_current_user)):
+    query_embedding = rag_service.get_query_embedding(request.query)
+    results = rag_service.vector_db.search_similar_risks(query_embedding, request.limit)
+    return {"results": results}
 
 @router.post("/similar-controls") 
-async def search_similar_controls(request: SearchRequest, user = Depends(get_current_user)):
-    try:
-        query_embedding = openai_service.get_embedding(request.query)
-        results = rag_service.vector_db.search_similar_controls(query_embedding, limit=request.limit)
-        return {"results": results}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+def search_similar_controls(request: SearchRequest, user = Depends(get_current_user)):
+    query_embedding = rag_service.get_query_embedding(request.query)
+    results = rag_service.vector_db.search_similar_controls(query_embedding, limit=request.limit)
+    return {"results": results}
 
 @router.post("/iso-guidance")
-async def search_iso_guidance(request: SearchRequest, user = Depends(get_current_user)):
-    try:
-        query_embedding = openai_service.get_embedding(request.query)
-        results = rag_service.vector_db.get_iso_guidance(query_embedding, request.limit)
-        return {"results": results}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+def search_iso_guidance(request: SearchRequest, user = Depends(get_current_user)):
+    query_embedding = rag_service.get_query_embedding(request.query)
+    results = rag_service.vector_db.get_iso_guidance(query_embedding, request.limit)
+    return {"results": results}
 
 @router.post("/comprehensive")
-async def comprehensive_search(request: SearchRequest, user = Depends(get_current_user)):
-    try:
-        context = rag_service._get_general_query_context(
-            openai_service.get_embedding(request.query),
-            user["username"]
-        )
-        return {"context": context}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+def comprehensive_search(request: SearchRequest, user = Depends(get_current_user)):
+    # Same context the agent retrieves for query_controls, so repeats
+    # are served from the per-user context cache without re-embedding
+    context = rag_service.retrieve_context_for_query(
+        request.query, "query_controls", {}, user["username"]
+    )
+    return {"context": context}
\ No newline at end of file
@@ -10,9 +10,9 @@ try:
     from app.postgres import postgres_service
     from app.config import POSTGRES_URI
     print(f"POSTGRES_URI: {POSTGRES_URI}")
-    print(f"Connection status: {postgres_service.conn is not None}")
+    print(f"Connection status: {postgres_service.pool is not None}")
     
-    if postgres_service.conn:
+    if postgres_service.pool:
         print("Testing vector search...")
         result = postgres_service.search_similar_controls([0.1] * 1536, limit=1)
         print(f"Search result: {result}")
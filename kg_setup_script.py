@@ -4,11 +4,12 @@ from typing import List, Dict
 from pymongo import MongoClient
 from neo4j import GraphDatabase
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import openai
 from datetime import datetime
 import sys
 import os
+import math
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -46,6 +47,29 @@ class KnowledgeGraphBuilder:
             print(f"Error getting embedding: {e}")
             return [0.0] * 1536
 
+    @staticmethod
+    def normalize(embedding: List[float]) -> List[float]:
+        # The app ranks with inner product (halfvec_ip_ops), which matches
+        # cosine only for unit-length vectors
+        norm = math.sqrt(sum(x * x for x in embedding))
+        return [x / norm for x in embedding] if norm else embedding
+
+    def get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        # One embeddings request per batch_size texts instead of one per text
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            chunk = texts[start:start + self.batch_size]
+            try:
+                response = self.openai_client.embeddings.create(
+                    model="text-embedding-ada-002",
+                    input=chunk
+                )
+                embeddings.extend(self.normalize(d.embedding) for d in sorted(response.data, key=lambda d: d.index))
+            except Exception as e:
+                print(f"Error getting embeddings for batch at {start}: {e}")
+                embeddings.extend([0.0] * 1536 for _ in chunk)
+        return embeddings
+
     def setup_postgres_tables(self):
         print("Setting up PostgreSQL tables...")
         with self.postgres_conn.cursor() as cur:
@@ -63,7 +87,7 @@ class KnowledgeGraphBuilder:
                     description TEXT,
                     category VARCHAR(255),
                     domain VARCHAR(255),
-                    embedding vector(1536),
+                    embedding halfvec(1536),
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
@@ -76,7 +100,7 @@ class KnowledgeGraphBuilder:
                     description TEXT,
                     annex_reference VARCHAR(10),
                     domain_category VARCHAR(100),
-                    embedding vector(1536),
+                    embedding halfvec(1536),
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
@@ -85,18 +109,18 @@ class KnowledgeGraphBuilder:
                     id SERIAL PRIMARY KEY,
                     annex_reference VARCHAR(10) UNIQUE,
                     guidance_text TEXT,
-                    embedding vector(1536),
+                    embedding halfvec(1536),
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
                 
                 CREATE INDEX risk_embedding_idx ON risk_embeddings 
-                USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+                USING hnsw (embedding halfvec_ip_ops);
                 
                 CREATE INDEX control_embedding_idx ON control_embeddings 
-                USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+                USING hnsw (embedding halfvec_ip_ops);
                 
                 CREATE INDEX iso_guidance_embedding_idx ON iso_guidance_embeddings 
-                USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+                USING hnsw (embedding halfvec_ip_ops);
             """)
             self.postgres_conn.commit()
         print("PostgreSQL tables created successfully!")
@@ -156,9 +180,9 @@ class KnowledgeGraphBuilder:
                         a.updated_at = datetime()
                 """, **annex)
         
+        embeddings = self.get_embeddings_batch([f"{annex['description']} {annex['guidance']}" for annex in annexes])
         with self.postgres_conn.cursor() as cur:
-            for annex in annexes:
-                embedding = self.get_embedding(f"{annex['description']} {annex['guidance']}")
+            for annex, embedding in zip(annexes, embeddings):
                 cur.execute("""
                     INSERT INTO iso_guidance_embeddings (annex_reference, guidance_text, embedding)
                     VALUES (%s, %s, %s)
@@ -253,6 +277,7 @@ class KnowledgeGraphBuilder:
         risk_categories = set()
         processed_ids = set()
         skipped = []
+        pending_embeddings = []
 
         for i, risk in enumerate(all_risks):
             if i % 50 == 0:
@@ -311,24 +336,24 @@ class KnowledgeGraphBuilder:
                         MERGE (r)-[:CATEGORIZED_AS]->(rc)
                     """, category=risk_data["category"], risk_id=risk_id)
             
-            embedding_text = f"{risk_data['description']} {risk_data['category']}"
-            embedding = self.get_embedding(embedding_text)
-            
-            with self.postgres_conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO risk_embeddings (risk_id, user_id, description, category, domain, embedding)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (risk_id) DO UPDATE SET
-                        description = EXCLUDED.description,
-                        category = EXCLUDED.category,
-                        domain = EXCLUDED.domain,
-                        embedding = EXCLUDED.embedding,
-                        updated_at = CURRENT_TIMESTAMP
-                """, (risk_id, risk["user_id"], risk_data["description"], 
-                     risk_data["category"], user_domain, embedding))
-            # log successful processing for this risk
-            if i % 10 == 0:
-                print(f"Inserted/updated risk embedding and node for risk_id={risk_id}")
+            pending_embeddings.append((
+                f"{risk_data['description']} {risk_data['category']}",
+                (risk_id, risk["user_id"], risk_data["description"], risk_data["category"], user_domain)
+            ))
+
+        print(f"Embedding {len(pending_embeddings)} risks...")
+        embeddings = self.get_embeddings_batch([text for text, _ in pending_embeddings])
+        with self.postgres_conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO risk_embeddings (risk_id, user_id, description, category, domain, embedding)
+                VALUES %s
+                ON CONFLICT (risk_id) DO UPDATE SET
+                    description = EXCLUDED.description,
+                    category = EXCLUDED.category,
+                    domain = EXCLUDED.domain,
+                    embedding = EXCLUDED.embedding,
+                    updated_at = CURRENT_TIMESTAMP
+            """, [(*row, embedding) for (_, row), embedding in zip(pending_embeddings, embeddings)], page_size=500)
         
         self.postgres_conn.commit()
         print(f"Processed {len(processed_ids)} unique risks, skipped {len(skipped)} items.\n")
@@ -344,6 +369,7 @@ class KnowledgeGraphBuilder:
     def process_controls(self):
         print("Processing controls...")
         controls = list(self.mongo_db.controls.find({}))
+        pending_embeddings = []
         
         for i, control in enumerate(controls):
             if i % 50 == 0:
@@ -399,23 +425,28 @@ class KnowledgeGraphBuilder:
                         MERGE (c)-[:BELONGS_TO]->(a)
                     """, control_id=control_id, annex_ref=annex_prefix)
             
-            embedding_text = f"{control_data['title']} {control_data['description']} {control_data['control_statement']}"
-            embedding = self.get_embedding(embedding_text)
-            
-            with self.postgres_conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO control_embeddings (control_id, user_id, title, description, annex_reference, domain_category, embedding)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (control_id) DO UPDATE SET
-                        title = EXCLUDED.title,
-                        description = EXCLUDED.description,
-                        annex_reference = EXCLUDED.annex_reference,
-                        domain_category = EXCLUDED.domain_category,
-                        embedding = EXCLUDED.embedding,
-                        updated_at = CURRENT_TIMESTAMP
-                """, (control_id, control_data["user_id"], control_data["title"],
-                     control_data["description"], control_data["annex_reference"],
-                     control_data["domain_category"], embedding))
+            pending_embeddings.append((
+                f"{control_data['title']} {control_data['description']} {control_data['control_statement']}",
+                (control_id, control_data["user_id"], control_data["title"], control_data["description"],
+                 control_data["annex_reference"], control_data["domain_category"])
+            ))
+
+        print(f"Embedding {len(pending_embeddings)} controls...")
+        embeddings = self.get_embeddings_batch([text for text, _ in pending_embeddings])
+        # Controls are keyed by their Mongo _id, so a single statement never
+        # touches the same row twice
+        with self.postgres_conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO control_embeddings (control_id, user_id, title, description, annex_reference, domain_category, embedding)
+                VALUES %s
+                ON CONFLICT (control_id) DO UPDATE SET
+                    title = EXCLUDED.title,
+                    description = EXCLUDED.description,
+                    annex_reference = EXCLUDED.annex_reference,
+                    domain_category = EXCLUDED.domain_category,
+                    embedding = EXCLUDED.embedding,
+                    updated_at = CURRENT_TIMESTAMP
+            """, [(*row, embedding) for (_, row), embedding in zip(pending_embeddings, embeddings)], page_size=500)
         
         self.postgres_conn.commit()
         print(f"Processed {len(controls)} controls successfully!")
@@ -498,14 +529,18 @@ class KnowledgeGraphBuilder:
             relationship_count = result.single()["relationship_count"]
         
         with self.postgres_conn.cursor() as cur:
-            cur.execute("SELECT count(*) FROM risk_embeddings")
-            risk_embeddings = cur.fetchone()[0]
-            
-            cur.execute("SELECT count(*) FROM control_embeddings")
-            control_embeddings = cur.fetchone()[0]
-            
-            cur.execute("SELECT count(*) FROM iso_guidance_embeddings")
-            iso_embeddings = cur.fetchone()[0]
+            # One round trip for all three tables
+            cur.execute("""
+                SELECT 'risk', count(*) FROM risk_embeddings
+                UNION ALL
+                SELECT 'control', count(*) FROM control_embeddings
+                UNION ALL
+                SELECT 'iso', count(*) FROM iso_guidance_embeddings
+            """)
+            counts = dict(cur.fetchall())
+            risk_embeddings = counts["risk"]
+            control_embeddings = counts["control"]
+            iso_embeddings = counts["iso"]
         
         print(f"Neo4j Nodes:")
         print(f"  Users: {user_count}")
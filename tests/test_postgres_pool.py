@@ -0,0 +1,108 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from psycopg2 import extensions
+
+from app import postgres
+from app.postgres import BlockingConnectionPool, PostgresVectorService
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if query.startswith("EXECUTE"):
+            # Hold the connection long enough for the other searches to pile up
+            time.sleep(0.05)
+
+    def fetchall(self):
+        return [{"risk_id": "risk-1", "similarity": 1.0}]
+
+
+class FakeInfo:
+    transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    closed = 0
+    info = FakeInfo()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool(BlockingConnectionPool):
+    def __init__(self, *args, **kwargs):
+        self.checked_out = 0
+        self.peak = 0
+        self._count_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _connect(self, key=None):
+        conn = FakeConnection()
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+    def getconn(self, key=None):
+        conn = super().getconn(key)
+        with self._count_lock:
+            self.checked_out += 1
+            self.peak = max(self.peak, self.checked_out)
+        return conn
+
+    def putconn(self, conn=None, key=None, close=False):
+        with self._count_lock:
+            self.checked_out -= 1
+        super().putconn(conn, key, close)
+
+
+def test_searches_wait_for_a_free_connection(monkeypatch):
+    monkeypatch.setattr(postgres, "POSTGRES_URI", None)
+    monkeypatch.setattr(postgres, "register_vector", lambda conn: None)
+    service = PostgresVectorService()
+    service.pool = FakePool(1, 2, timeout=5)
+
+    rng = np.random.default_rng(0)
+    queries = [rng.standard_normal(1536).astype(np.float32) for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        results = list(executor.map(service.search_similar_risks, queries))
+
+    assert all(result == [{"risk_id": "risk-1", "similarity": 1.0}] for result in results)
+    assert service.pool.peak == 2
+    assert service.pool.checked_out == 0
+
+
+def test_getconn_times_out_when_pool_stays_exhausted():
+    pool = FakePool(1, 1, timeout=0.05)
+    conn = pool.getconn()
+    try:
+        pool.getconn()
+    except postgres.PoolError:
+        pass
+    else:
+        raise AssertionError("expected PoolError")
+    finally:
+        pool.putconn(conn)
+    pool.putconn(pool.getconn())
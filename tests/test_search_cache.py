@@ -0,0 +1,50 @@
+import numpy as np
+
+from app import postgres
+from app.postgres import PostgresVectorService, cached_search
+
+
+class CountingService(PostgresVectorService):
+    calls = 0
+
+    @cached_search
+    def search_similar_risks(self, query_embedding, limit: int = 5):
+        self.calls += 1
+        return [{"risk_id": "risk-1", "similarity": 1.0}]
+
+    @cached_search
+    def search_all(self, query_embedding, user_id: str, control_limit: int = 5):
+        self.calls += 1
+        return {"similar_controls": [{"control_id": "control-1"}], "similar_risks": []}
+
+
+def make_service(monkeypatch):
+    monkeypatch.setattr(postgres, "POSTGRES_URI", None)
+    service = CountingService()
+    service.pool = object()
+    return service
+
+
+def test_equivalent_calls_share_a_cache_entry(monkeypatch):
+    service = make_service(monkeypatch)
+    query = np.ones(1536, dtype=np.float32)
+
+    service.search_similar_risks(query)
+    service.search_similar_risks(query, 5)
+    service.search_similar_risks(query, limit=5)
+    assert service.calls == 1
+
+    service.search_similar_risks(query, limit=3)
+    assert service.calls == 2
+
+
+def test_cache_hits_return_copies(monkeypatch):
+    service = make_service(monkeypatch)
+    query = np.ones(1536, dtype=np.float32)
+
+    service.search_similar_risks(query)[0]["similarity"] = 0.0
+    assert service.search_similar_risks(query)[0]["similarity"] == 1.0
+
+    service.search_all(query, "alice")["similar_controls"][0]["title"] = "changed"
+    assert "title" not in service.search_all(query, user_id="alice")["similar_controls"][0]
+    assert service.calls == 2